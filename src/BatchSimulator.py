@@ -0,0 +1,241 @@
+import math
+import numpy as np
+
+
+SEGMENT_NORMAL = 0
+SEGMENT_SAND = 1
+SEGMENT_STICKY = 2
+
+
+class BatchSegment:
+    def __init__(self, a, b, radius, friction, elasticity, kind):
+        self.a = a
+        self.b = b
+        self.radius = radius
+        self.friction = friction
+        self.elasticity = elasticity
+        self.kind = kind
+
+
+class BallPaths:
+    def __init__(self, positions, rest_update_nums, reached_flag, is_stuck):
+        # Positions after every update, shaped (num_updates + 1, num_balls, 2),
+        # or just the end positions shaped (1, num_balls, 2).
+        self.positions = positions
+        # The update each ball came to rest in, or -1 if it never did.
+        self.rest_update_nums = rest_update_nums
+        self.reached_flag = reached_flag
+        self.is_stuck = is_stuck
+
+    @property
+    def end_positions(self):
+        return self.positions[-1]
+
+
+# Simulates many balls at once, each on its own, with their positions and
+# velocities kept in arrays so that every step is a handful of numpy operations
+# over all of them. It follows the order chipmunk steps in: balls are moved,
+# contacts found, gravity applied and then contacts resolved, bouncing only off
+# the speed a ball hit a segment with. Friction and elasticity are combined by
+# multiplying them as chipmunk does, sticky segments stop a ball and switch off
+# its gravity, and a ball touching the flag is held there.
+#
+# Contacts are resolved in one pass rather than iterated, and all balls share
+# the substep count of the fastest one, so paths follow the same physics as
+# Physics without being identical to it. Segments are found through a uniform
+# grid, in which every cell has a padded row of the segments a ball in it could
+# touch.
+class BatchSimulator:
+    cell_size = 1
+    # As in a default pymunk space.
+    collision_slop = 0.1
+    collision_bias = (1 - 0.1) ** 60
+
+    def __init__(
+        self,
+        segments,
+        ball_radius,
+        ball_friction,
+        ball_elasticity,
+        gravity,
+        dt,
+        max_ball_step_distance,
+        flag_position=None,
+        flag_width=None,
+    ):
+        self._ball_radius = ball_radius
+        self._gravity = np.array([gravity[0], gravity[1]], dtype=np.float64)
+        self.dt = dt
+        self._max_ball_step_distance = max_ball_step_distance
+        # Kept as a plain pair, as pyglet's Vec2 can't be unpickled in the
+        # worker processes simulators are sent to.
+        self.flag_position = (
+            None if flag_position is None else (flag_position[0], flag_position[1])
+        )
+        self._flag_width = flag_width
+
+        # The last segment is a dummy one far away which pads the grid rows.
+        far = 1e9
+        self._a = np.array([s.a for s in segments] + [(far, far)], dtype=np.float64)
+        self._b = np.array([s.b for s in segments] + [(far, far)], dtype=np.float64)
+        ab = self._b - self._a
+        # Everything a contact needs about a segment, as rows of one table so
+        # that it is gathered for all candidate segments at once.
+        self._segment_table = np.stack(
+            [
+                self._a[:, 0],
+                self._a[:, 1],
+                ab[:, 0],
+                ab[:, 1],
+                1 / np.maximum(ab[:, 0] ** 2 + ab[:, 1] ** 2, 1e-12),
+                (ball_radius + np.array([s.radius for s in segments] + [0])) ** 2,
+            ]
+        )
+        self._reach = ball_radius + np.array([s.radius for s in segments] + [0])
+        self._friction = ball_friction * np.array([s.friction for s in segments] + [0])
+        self._elasticity = ball_elasticity * np.array(
+            [s.elasticity for s in segments] + [0]
+        )
+        self._is_sticky = np.array(
+            [s.kind == SEGMENT_STICKY for s in segments] + [False]
+        )
+        self._make_grid(segments)
+
+    def _make_grid(self, segments):
+        padding = self._ball_radius + max((s.radius for s in segments), default=0)
+        self._min_cell = np.floor(
+            (np.minimum(self._a[:-1], self._b[:-1]).min(axis=0) - padding)
+            / self.cell_size
+        ).astype(np.int64)
+        max_cell = np.floor(
+            (np.maximum(self._a[:-1], self._b[:-1]).max(axis=0) + padding)
+            / self.cell_size
+        ).astype(np.int64)
+        self._grid_size = max_cell - self._min_cell + 1
+        cells = [[] for _ in range(self._grid_size[0] * self._grid_size[1] + 1)]
+        for i, segment in enumerate(segments):
+            lo = np.floor(
+                (np.minimum(segment.a, segment.b) - padding) / self.cell_size
+            ).astype(np.int64)
+            hi = np.floor(
+                (np.maximum(segment.a, segment.b) + padding) / self.cell_size
+            ).astype(np.int64)
+            for x in range(lo[0], hi[0] + 1):
+                for y in range(lo[1], hi[1] + 1):
+                    cells[self._get_cell_idx(x, y)].append(i)
+        # The extra last cell is for balls outside the grid, and stays empty.
+        row_length = max(len(cell) for cell in cells)
+        self._cell_segments = np.full((len(cells), row_length), len(segments))
+        for i, cell in enumerate(cells):
+            self._cell_segments[i, : len(cell)] = cell
+
+    def _get_cell_idx(self, x, y):
+        return (x - self._min_cell[0]) * self._grid_size[1] + (y - self._min_cell[1])
+
+    def _get_candidate_segments(self, positions):
+        cells = np.floor(positions / self.cell_size).astype(np.int64) - self._min_cell
+        is_inside = np.all((cells >= 0) & (cells < self._grid_size), axis=1)
+        cell_idxs = np.where(
+            is_inside,
+            cells[:, 0] * self._grid_size[1] + cells[:, 1],
+            len(self._cell_segments) - 1,
+        )
+        return self._cell_segments[cell_idxs]
+
+    def _get_is_touching_flag(self, positions):
+        if self.flag_position is None:
+            return np.zeros(len(positions), dtype=bool)
+        offset = positions - np.array([self.flag_position[0], self.flag_position[1]])
+        closest_x = np.clip(offset[:, 0], -self._flag_width / 2, self._flag_width / 2)
+        closest_y = np.clip(offset[:, 1], -0.1, 0.1)
+        return (offset[:, 0] - closest_x) ** 2 + (
+            offset[:, 1] - closest_y
+        ) ** 2 < self._ball_radius**2
+
+    def _substep(self, positions, velocities, gravity_scale, h):
+        positions += velocities * h
+        segments = self._get_candidate_segments(positions)
+        ax, ay, abx, aby, inv_ab_length_sqrd, reach_sqrd = self._segment_table[
+            :, segments
+        ]
+        apx = positions[:, 0, None] - ax
+        apy = positions[:, 1, None] - ay
+        t = np.clip((apx * abx + apy * aby) * inv_ab_length_sqrd, 0, 1)
+        dx = apx - t * abx
+        dy = apy - t * aby
+        distance_sqrd = dx**2 + dy**2
+        is_contact = (distance_sqrd < reach_sqrd) & (distance_sqrd > 1e-24)
+        pre_velocities = velocities.copy()
+        velocities += self._gravity * (gravity_scale * h)[:, None]
+
+        is_stuck = np.any(is_contact & self._is_sticky[segments], axis=1)
+        bias_coef = 1 - self.collision_bias**h
+        # A ball can touch more than one segment, so each column of candidates
+        # is resolved in turn.
+        for k in np.flatnonzero(np.any(is_contact, axis=0)):
+            balls = np.flatnonzero(is_contact[:, k])
+            seg = segments[balls, k]
+            distance = np.sqrt(distance_sqrd[balls, k])
+            nx = dx[balls, k] / distance
+            ny = dy[balls, k] / distance
+            vx = velocities[balls, 0]
+            vy = velocities[balls, 1]
+            pre_vn = pre_velocities[balls, 0] * nx + pre_velocities[balls, 1] * ny
+            vn = vx * nx + vy * ny
+            jn = np.maximum(-self._elasticity[seg] * np.minimum(pre_vn, 0) - vn, 0)
+            vt = vy * nx - vx * ny
+            max_jt = self._friction[seg] * jn
+            jt = np.clip(-vt, -max_jt, max_jt)
+            velocities[balls, 0] = vx + nx * jn - ny * jt
+            velocities[balls, 1] = vy + ny * jn + nx * jt
+            correction = (
+                np.maximum(self._reach[seg] - distance - self.collision_slop, 0)
+                * bias_coef
+            )
+            positions[balls, 0] += nx * correction
+            positions[balls, 1] += ny * correction
+        return is_stuck
+
+    # Without is_path_kept only the end positions are kept, which is all a
+    # search needs and much less to send back from a worker process.
+    def simulate(self, positions, velocities, num_updates, is_path_kept=True):
+        # Copied pair by pair, as numpy can't convert pyglet's Vec2 itself.
+        positions = np.array([(p[0], p[1]) for p in positions], dtype=np.float64)
+        velocities = np.array([(v[0], v[1]) for v in velocities], dtype=np.float64)
+        num_balls = len(positions)
+        path = np.empty((num_updates + 1 if is_path_kept else 1, num_balls, 2))
+        path[0] = positions
+        gravity_scale = np.ones(num_balls)
+        rest_update_nums = np.full(num_balls, -1)
+        reached_flag = np.zeros(num_balls, dtype=bool)
+        is_stuck = np.zeros(num_balls, dtype=bool)
+        is_moving = np.ones(num_balls, dtype=bool)
+        for update_num in range(1, num_updates + 1):
+            moving = np.flatnonzero(is_moving)
+            if len(moving) == 0:
+                if is_path_kept:
+                    path[update_num:] = positions
+                break
+            p = positions[moving]
+            v = velocities[moving]
+            max_speed = math.sqrt(np.einsum("ij,ij->i", v, v).max())
+            num_substeps = max(
+                1, math.ceil(max_speed * self.dt / self._max_ball_step_distance)
+            )
+            for _ in range(num_substeps):
+                did_stick = self._substep(
+                    p, v, gravity_scale[moving], self.dt / num_substeps
+                )
+                v[did_stick] = 0
+                gravity_scale[moving[did_stick]] = 0
+                is_stuck[moving[did_stick]] = True
+            positions[moving] = p
+            velocities[moving] = v
+            path[update_num if is_path_kept else 0] = positions
+
+            is_in_hole = self._get_is_touching_flag(p)
+            reached_flag[moving[is_in_hole]] = True
+            is_at_rest = np.einsum("ij,ij->i", v, v) < 0.000000001
+            rest_update_nums[moving[is_at_rest | is_in_hole]] = update_num
+            is_moving[moving[is_at_rest | is_in_hole]] = False
+        return BallPaths(path, rest_update_nums, reached_flag, is_stuck)
@@ -0,0 +1,179 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from random import getrandbits
+import pyglet
+from cave_cache import load_or_gen_cave
+from config import config
+from tracing import get_traced_result, span, submit_traced
+
+
+# How many times a requested cave is generated in a worker before giving up on
+# the workers and generating it in this process instead.
+_max_worker_attempts = 3
+
+
+class _CaveRequest:
+    def __init__(self, mode, cave_args, future, on_cave):
+        self.mode = mode
+        self.cave_args = cave_args
+        self.future = future
+        self.on_cave = on_cave
+        self.num_attempts = 1
+
+
+# Generates caves in worker processes so that generation doesn't compete with
+# the render loop for the GIL. A few caves are kept queued ahead of time for
+# each mode, and finished caves are handed back on the main thread by polling
+# from the clock. Every cave gets its own seed, and caves are cached on disk
+# when there is a cache_dir.
+class CaveGenerator:
+    def __init__(self, num_processes, look_ahead, poll_interval, cache_dir):
+        self._num_processes = num_processes
+        self._look_ahead = look_ahead
+        self._poll_interval = poll_interval
+        self._cache_dir = cache_dir
+        self._executor = None
+        self._queued_caves = {}
+        self._requests = []
+        self._is_polling = False
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Spawned rather than forked, as forking copies the window, the GL
+            # context and the audio threads into every worker.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._num_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def _submit(self, cave_args):
+        args = (load_or_gen_cave, self._cache_dir, *cave_args, getrandbits(64))
+        try:
+            return submit_traced(self._get_executor(), *args)
+        except BrokenProcessPool:
+            # A worker died, which breaks the whole pool, so start a new one.
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            return submit_traced(self._get_executor(), *args)
+
+    def _gen_cave_here(self, cave_args):
+        return load_or_gen_cave(self._cache_dir, *cave_args, getrandbits(64))
+
+    def _get_queue(self, mode):
+        if mode not in self._queued_caves:
+            self._queued_caves[mode] = deque()
+        return self._queued_caves[mode]
+
+    def prefetch(self, mode, cave_args):
+        queue = self._get_queue(mode)
+        while len(queue) < self._look_ahead:
+            queue.append(self._submit(cave_args))
+
+    # Blocks until a cave is ready. If none has been queued yet, or a specific
+    # seed is asked for, or the worker fails, the cave is generated in this
+    # process rather than waiting for a worker to start up.
+    def get_cave(self, mode, cave_args, seed=None):
+        queue = self._get_queue(mode)
+        with span("get_cave"):
+            if seed is not None:
+                cave = load_or_gen_cave(self._cache_dir, *cave_args, seed)
+            elif queue:
+                try:
+                    cave = get_traced_result(queue.popleft())
+                # pylint: disable-next=broad-except
+                except Exception as e:
+                    print(f"Cave generation failed in a worker: {e!r}")
+                    cave = self._gen_cave_here(cave_args)
+            else:
+                cave = self._gen_cave_here(cave_args)
+        self.prefetch(mode, cave_args)
+        return cave
+
+    # Calls on_cave with the next cave for the mode on the main thread once it is
+    # ready. Returns a request which can be passed to cancel_request.
+    def request_cave(self, mode, cave_args, on_cave):
+        queue = self._get_queue(mode)
+        if queue:
+            future = queue.popleft()
+        else:
+            future = self._submit(cave_args)
+        request = _CaveRequest(mode, cave_args, future, on_cave)
+        self.prefetch(mode, cave_args)
+        self._requests.append(request)
+        self._update_polling()
+        return request
+
+    def cancel_request(self, request):
+        if request not in self._requests:
+            return
+        self._requests.remove(request)
+        self._update_polling()
+        # Nobody is waiting for the cave any more, so keep it for the next hole.
+        self._get_queue(request.mode).appendleft(request.future)
+
+    # Drops every pending request and cancels the queued caves which haven't
+    # started generating yet. Caves which are done or being generated are kept.
+    def cancel(self):
+        self._requests = []
+        self._update_polling()
+        for mode, queue in self._queued_caves.items():
+            self._queued_caves[mode] = deque(
+                future for future in queue if not future.cancel()
+            )
+
+    # A cave whose worker fails, whether gen_cave raised or the worker died, is
+    # asked for again with a new seed, and after _max_worker_attempts failures
+    # it is generated in this process. Exceptions mustn't escape this clock
+    # callback, as they would end the game loop.
+    def _poll(self, _dt):
+        for request in [r for r in self._requests if r.future.done()]:
+            # An earlier callback may have cancelled the remaining requests.
+            if request not in self._requests:
+                continue
+            try:
+                cave = get_traced_result(request.future)
+            # pylint: disable-next=broad-except
+            except Exception as e:
+                print(f"Cave generation failed in a worker: {e!r}")
+                if request.num_attempts < _max_worker_attempts:
+                    request.num_attempts += 1
+                    request.future = self._submit(request.cave_args)
+                    continue
+                cave = self._gen_cave_here(request.cave_args)
+            self._requests.remove(request)
+            request.on_cave(cave)
+        self._update_polling()
+
+    def _update_polling(self):
+        should_poll = len(self._requests) > 0
+        if should_poll and not self._is_polling:
+            pyglet.clock.schedule_interval(self._poll, self._poll_interval)
+        elif not should_poll and self._is_polling:
+            pyglet.clock.unschedule(self._poll)
+        self._is_polling = should_poll
+
+    def shutdown(self):
+        self.cancel()
+        self._queued_caves = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_cave_generator = None
+
+
+def cave_generator():
+    # pylint: disable-next=global-statement
+    global _cave_generator
+    if _cave_generator is None:
+        _cave_generator = CaveGenerator(
+            num_processes=config().cave_generation_processes,
+            look_ahead=config().cave_generation_look_ahead,
+            poll_interval=config().cave_generation_poll_interval,
+            cache_dir=config().cave_cache_dir,
+        )
+    return _cave_generator
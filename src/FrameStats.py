@@ -0,0 +1,161 @@
+import csv
+import json
+import numpy as np
+
+
+# Keeps the timings of the last capacity frames in a ring buffer, in seconds:
+# the time since the last frame, and how long the updates, the render and the
+# GUI took within it. Frames also keep how many updates they ran, and how many
+# were dropped when catching up after a stall. GPU times of the render passes
+# come in a few frames late, so they're kept apart from the rest, in
+# milliseconds, as NaN for frames which didn't have the pass.
+class FrameStats:
+    columns = ["frame", "update", "render", "gui", "num_updates", "dropped_updates"]
+    time_columns = ["frame", "update", "render", "gui"]
+
+    def __init__(self, capacity):
+        self._frames = np.zeros((capacity, len(self.columns)))
+        self._next_frame_idx = 0
+        self.num_frames = 0
+        self._gpu_pass_times = {}
+        self._next_gpu_frame_idx = 0
+        self.num_gpu_frames = 0
+
+    def add_frame(self, frame, update, render, gui, num_updates, dropped_updates):
+        self._frames[self._next_frame_idx] = (
+            frame,
+            update,
+            render,
+            gui,
+            num_updates,
+            dropped_updates,
+        )
+        self._next_frame_idx = (self._next_frame_idx + 1) % len(self._frames)
+        self.num_frames = min(self.num_frames + 1, len(self._frames))
+
+    def add_gpu_frame(self, pass_times):
+        for times in self._gpu_pass_times.values():
+            times[self._next_gpu_frame_idx] = np.nan
+        for name, time in pass_times.items():
+            if name not in self._gpu_pass_times:
+                self._gpu_pass_times[name] = np.full(len(self._frames), np.nan)
+            self._gpu_pass_times[name][self._next_gpu_frame_idx] = time
+        self._next_gpu_frame_idx = (self._next_gpu_frame_idx + 1) % len(self._frames)
+        self.num_gpu_frames = min(self.num_gpu_frames + 1, len(self._frames))
+
+    # The GPU milliseconds of each pass over the frames kept, oldest first.
+    def get_gpu_pass_times(self):
+        if self.num_gpu_frames < len(self._frames):
+            return {
+                name: times[: self.num_gpu_frames]
+                for name, times in self._gpu_pass_times.items()
+            }
+        return {
+            name: np.roll(times, -self._next_gpu_frame_idx)
+            for name, times in self._gpu_pass_times.items()
+        }
+
+    def get_gpu_pass_percentiles(self, percentiles=(50, 95, 99)):
+        pass_percentiles = {}
+        for name, times in self.get_gpu_pass_times().items():
+            times = times[~np.isnan(times)]
+            if len(times):
+                values = np.percentile(times, percentiles)
+                pass_percentiles[name] = dict(zip(percentiles, values.tolist()))
+        return pass_percentiles
+
+    # The frames kept, oldest first, with a row for each frame.
+    def get_frames(self):
+        if self.num_frames < len(self._frames):
+            return self._frames[: self.num_frames]
+        return np.roll(self._frames, -self._next_frame_idx, axis=0)
+
+    def get_column(self, column):
+        return self.get_frames()[:, self.columns.index(column)]
+
+    def get_percentiles(self, column, percentiles=(50, 95, 99)):
+        if self.num_frames == 0:
+            return {p: 0.0 for p in percentiles}
+        values = np.percentile(self.get_column(column), percentiles)
+        return dict(zip(percentiles, values.tolist()))
+
+    # Counts of frames in bins of bin_width seconds, where the last bin also
+    # has every frame longer than the bins reach. Returns the counts and the
+    # edges of the bins.
+    def get_histogram(self, column, bin_width=0.002, num_bins=25):
+        edges = np.arange(num_bins + 1) * bin_width
+        values = np.minimum(self.get_column(column), edges[-1])
+        counts, _ = np.histogram(values, bins=edges)
+        return counts.tolist(), edges.tolist()
+
+    def get_summary(self):
+        frames = self.get_frames()
+        summary = {"num_frames": self.num_frames}
+        for column in self.time_columns:
+            values = frames[:, self.columns.index(column)]
+            counts, edges = self.get_histogram(column)
+            summary[column] = {
+                "mean_ms": float(values.mean()) * 1000 if len(values) else 0.0,
+                "max_ms": float(values.max()) * 1000 if len(values) else 0.0,
+                "percentiles_ms": {
+                    f"p{p}": v * 1000 for p, v in self.get_percentiles(column).items()
+                },
+                "histogram": {
+                    "edges_ms": [edge * 1000 for edge in edges],
+                    "counts": counts,
+                },
+            }
+        summary["catch_up_frames"] = int(
+            np.count_nonzero(frames[:, self.columns.index("num_updates")] > 1)
+        )
+        summary["dropped_updates"] = int(
+            frames[:, self.columns.index("dropped_updates")].sum()
+        )
+        summary["gpu_frames"] = self.num_gpu_frames
+        summary["gpu_passes"] = {}
+        gpu_pass_percentiles = self.get_gpu_pass_percentiles()
+        for name, times in self.get_gpu_pass_times().items():
+            times = times[~np.isnan(times)]
+            if len(times) == 0:
+                continue
+            summary["gpu_passes"][name] = {
+                "frames": len(times),
+                "mean_ms": float(times.mean()),
+                "max_ms": float(times.max()),
+                "percentiles_ms": {
+                    f"p{p}": v for p, v in gpu_pass_percentiles[name].items()
+                },
+            }
+        return summary
+
+    def _get_rows(self):
+        header = [f"{column}_ms" for column in self.time_columns] + self.columns[
+            len(self.time_columns) :
+        ]
+        rows = []
+        for frame in self.get_frames():
+            rows.append(
+                [t * 1000 for t in frame[: len(self.time_columns)]]
+                + [int(n) for n in frame[len(self.time_columns) :]]
+            )
+        return header, rows
+
+    # Saves every frame kept as CSV if the path ends in .csv, or otherwise the
+    # summary, which has the GPU pass times, and every frame as JSON.
+    def save(self, path):
+        header, rows = self._get_rows()
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(rows)
+            else:
+                json.dump(
+                    {
+                        "summary": self.get_summary(),
+                        "columns": header,
+                        "frames": rows,
+                    },
+                    f,
+                    indent=2,
+                )
@@ -0,0 +1,112 @@
+from time import time
+import numpy as np
+import pyglet
+from pyglet import gl
+from pyglet.math import Mat4
+from Geometry import single_color_shader
+from gl_util import Buffer, normalize_color
+
+
+# Draws a graph of the last frames in the bottom left of the window, with a bar
+# for each frame split into the time its updates, render and GUI took, a line at
+# the target frame time, and the frame time percentiles.
+class FrameStatsOverlay:
+    def __init__(
+        self,
+        frame_stats,
+        target_frame_time,
+        num_bars=240,
+        bar_width=2,
+        pixels_per_second=4000,
+        label_refresh_interval=0.5,
+    ):
+        self._frame_stats = frame_stats
+        self._target_frame_time = target_frame_time
+        self._num_bars = num_bars
+        self._bar_width = bar_width
+        self._pixels_per_second = pixels_per_second
+        self._label_refresh_interval = label_refresh_interval
+        self._phase_colors = [
+            ("update", (66, 135, 245)),
+            ("render", (80, 200, 90)),
+            ("gui", (240, 200, 60)),
+        ]
+        # Two triangles for each bar of each phase, then two for the target line.
+        self._num_vertices = (len(self._phase_colors) * num_bars + 1) * 6
+        self._vertex_buffer = Buffer(
+            [0] * self._num_vertices * 2, 2, "float", is_dynamic=True
+        )
+        self._label = pyglet.text.Label("", font_size=10, x=4, y=4)
+        self._label_refresh_time = 0
+
+    def _get_rect_vertices(self, x0, y0, x1, y1):
+        return np.stack(
+            [x0, y0, x1, y0, x1, y1, x0, y0, x1, y1, x0, y1], axis=-1
+        ).ravel()
+
+    def render(self, window_width, window_height):
+        frames = self._frame_stats.get_frames()[-self._num_bars :]
+        x0 = np.arange(self._num_bars - len(frames), self._num_bars) * float(
+            self._bar_width
+        )
+        graph_bottom = 20
+        bottom = np.full(len(frames), float(graph_bottom))
+        vertices = []
+        for phase, _ in self._phase_colors:
+            top = (
+                bottom
+                + frames[:, self._frame_stats.columns.index(phase)]
+                * self._pixels_per_second
+            )
+            rects = self._get_rect_vertices(x0, bottom, x0 + self._bar_width, top)
+            vertices.append(
+                np.pad(rects, (0, self._num_bars * 12 - len(rects)), "constant")
+            )
+            bottom = top
+        line_y = graph_bottom + self._target_frame_time * self._pixels_per_second
+        vertices.append(
+            self._get_rect_vertices(
+                np.array([0.0]),
+                np.array([line_y]),
+                np.array([float(self._num_bars * self._bar_width)]),
+                np.array([line_y + 1]),
+            )
+        )
+        self._vertex_buffer.update_part(np.concatenate(vertices).tolist(), 0)
+
+        single_color_shader.use()
+        view_matrix = Mat4.orthogonal_projection(
+            0, window_width, 0, window_height, -1, 1
+        )
+        # pylint: disable=assigning-non-slot
+        single_color_shader.uniforms.u_view_matrix = [
+            view_matrix.column(i) for i in range(4)
+        ]
+        single_color_shader.uniforms.u_alpha = 0.8
+        # pylint: enable=assigning-non-slot
+        self._vertex_buffer.bind_to_attrib(
+            single_color_shader.attributes.a_vertex_position
+        )
+        for i, (_, color) in enumerate(self._phase_colors):
+            # pylint: disable-next=assigning-non-slot
+            single_color_shader.uniforms.u_color = normalize_color(color)
+            gl.glDrawArrays(gl.GL_TRIANGLES, i * self._num_bars * 6, len(frames) * 6)
+        # pylint: disable-next=assigning-non-slot
+        single_color_shader.uniforms.u_color = (1, 1, 1)
+        gl.glDrawArrays(gl.GL_TRIANGLES, self._num_vertices - 6, 6)
+        single_color_shader.clear()
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+        # Refreshed now and then, as laying out text every frame costs more than
+        # the graph.
+        if time() - self._label_refresh_time > self._label_refresh_interval:
+            self._label_refresh_time = time()
+            percentiles = self._frame_stats.get_percentiles("frame")
+            self._label.text = "frame " + "  ".join(
+                f"p{p} {v * 1000:.1f} ms" for p, v in percentiles.items()
+            )
+        self._label.draw()
+
+    def dispose(self):
+        self._vertex_buffer.dispose()
+        self._label.delete()
@@ -1,9 +1,13 @@
-from time import time
+from time import perf_counter, time
 import pyglet
 import pyglet.gl
 import glooey
 from widgets import large_window_width, large_window_height
 from assets import assets
+from FrameStats import FrameStats
+from FrameStatsOverlay import FrameStatsOverlay
+from GpuProfiler import gpu_profiler
+import tracing
 
 
 class MyGui(glooey.Gui):
@@ -12,9 +16,33 @@ class MyGui(glooey.Gui):
 
 
 class Game:
-    def __init__(self, screen, updates_per_second, target_fps):
+    def __init__(
+        self,
+        screen,
+        updates_per_second,
+        target_fps,
+        max_updates_per_tick,
+        frame_stats_capacity,
+        frame_stats_overlay_keys,
+        is_frame_stats_overlay_shown,
+        trace_keys,
+        trace_dir,
+        gpu_profiler_keys,
+    ):
         self.updates_per_second = updates_per_second
         self._target_fps = target_fps
+        self._max_updates_per_tick = max_updates_per_tick
+        self.frame_stats = FrameStats(frame_stats_capacity)
+        self._frame_stats_overlay_keys = frame_stats_overlay_keys
+        self._is_frame_stats_overlay_shown = is_frame_stats_overlay_shown
+        self._frame_stats_overlay = None
+        self._gui_time = 0
+        self._trace_keys = trace_keys
+        self._trace_dir = trace_dir
+        self._gpu_profiler_keys = gpu_profiler_keys
+        # How far the frame being drawn is from the last update towards the
+        # next, for interpolating between them.
+        self.interpolation_alpha = 1
         self._last_time = time()
         self.window = pyglet.window.Window(
             config=pyglet.gl.Config(
@@ -30,7 +58,6 @@ class Game:
         self.window.set_minimum_size(640, 480)
         self.gui = MyGui(self.window)
         self._screen = screen
-        self._average_dt = []
         self._resize_handlers = []
         self.size = self._get_size()
         self._bgm_player = None
@@ -50,6 +77,17 @@ class Game:
         def on_key_press(symbol, _modifiers):
             if symbol == pyglet.window.key.ESCAPE:
                 return pyglet.event.EVENT_HANDLED
+            if symbol in self._frame_stats_overlay_keys:
+                self._is_frame_stats_overlay_shown = (
+                    not self._is_frame_stats_overlay_shown
+                )
+                return pyglet.event.EVENT_HANDLED
+            if symbol in self._trace_keys:
+                self.toggle_tracing()
+                return pyglet.event.EVENT_HANDLED
+            if symbol in self._gpu_profiler_keys:
+                gpu_profiler().set_is_enabled(not gpu_profiler().is_enabled)
+                return pyglet.event.EVENT_HANDLED
 
         def on_resize(_w, _h):
             new_size = self._get_size()
@@ -63,22 +101,66 @@ class Game:
         pyglet.clock.schedule_interval(self._tick, 1 / self._target_fps)
         pyglet.app.run()
 
-    def _tick(self, dt):
-        self._average_dt.append(dt)
-        if len(self._average_dt) == 60:
-            print("fps", len(self._average_dt) / sum(self._average_dt))
-            self._average_dt = []
+    # Starts tracing, or stops it and saves the trace.
+    def toggle_tracing(self):
+        if tracing.is_enabled():
+            tracing.stop()
+            print("trace saved to", tracing.save(self._trace_dir))
+            tracing.clear()
+        else:
+            tracing.start()
+
+    @tracing.traced
+    def _tick(self, frame_time):
+        update_start = perf_counter()
         cur_time = time()
         num_updates = int((cur_time - self._last_time) * self.updates_per_second)
+        dropped_updates = max(num_updates - self._max_updates_per_tick, 0)
+        if num_updates > self._max_updates_per_tick:
+            # After a stall, catching up on every update would make this tick
+            # even longer and the next one further behind, so the time which
+            # can't be caught up on is dropped and the game slows down instead.
+            num_updates = self._max_updates_per_tick
+            self._last_time = cur_time - num_updates / self.updates_per_second
         self._last_time += num_updates / self.updates_per_second
+        self.interpolation_alpha = min(
+            (cur_time - self._last_time) * self.updates_per_second, 1
+        )
         dt = 1 / self.updates_per_second
-        for _ in range(num_updates):
-            if self._screen.update(dt) is False:
-                break
+        with tracing.span("updates", num_updates=num_updates):
+            for _ in range(num_updates):
+                if self._screen.update(dt) is False:
+                    break
+        render_start = perf_counter()
+        self._gui_time = 0
+        gpu_pass_times = gpu_profiler().begin_frame()
         self._screen.render()
+        gpu_profiler().end_frame()
+        render_end = perf_counter()
+        self.frame_stats.add_frame(
+            frame=frame_time,
+            update=render_start - update_start,
+            render=render_end - render_start - self._gui_time,
+            gui=self._gui_time,
+            num_updates=num_updates,
+            dropped_updates=dropped_updates,
+        )
+        if gpu_pass_times is not None:
+            self.frame_stats.add_gpu_frame(gpu_pass_times)
+        if self._is_frame_stats_overlay_shown:
+            if self._frame_stats_overlay is None:
+                self._frame_stats_overlay = FrameStatsOverlay(
+                    self.frame_stats, target_frame_time=1 / self._target_fps
+                )
+            self._frame_stats_overlay.render(self.window.width, self.window.height)
 
     def draw_gui(self):
-        self.gui.batch.draw()
+        start = perf_counter()
+        gpu_profiler().begin_pass("gui")
+        with tracing.span("gui"):
+            self.gui.batch.draw()
+        gpu_profiler().end_pass()
+        self._gui_time += perf_counter() - start
 
     def set_is_sound_enabled(self, is_sound_enabled):
         if self.is_sound_enabled == is_sound_enabled:
@@ -105,4 +187,8 @@ class Game:
 
     def quit(self):
         self._screen.unbind()
+        if self._frame_stats_overlay is not None:
+            self._frame_stats_overlay.dispose()
+            self._frame_stats_overlay = None
+        gpu_profiler().dispose()
         self.window.close()
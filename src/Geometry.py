@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from random import random
 import math
 import pyglet
@@ -15,9 +16,12 @@ from Rectangle import Rectangle
 from Tessellator import Tessellator
 from Physics import add_sticky_to_stickies
 from gl_util import Buffer, IndexedVertices, normalize_color, clear_gl
+from tracing import traced
+from GpuProfiler import gpu_profiler
 
 BUFFER_RESOLUTION = 8
 CIRCLE_POINTS = 64
+MAX_CACHED_PREVIEW_STICKIES = 8
 
 
 single_color_shader = pyshaders.from_string(
@@ -329,6 +333,7 @@ class Geometry:
         self._sand_pits_indexed_vertices = None
         self._sand_pits_3d_ground_indexed_vertices = None
         self._stickies_indexed_vertices = []
+        self._preview_sticky_indexed_vertices = OrderedDict()
         self._start_flat_indexed_vertices = None
         self._flag_flat_indexed_vertices = None
         self._dynamic_wall_indexed_vertices = None
@@ -365,6 +370,7 @@ class Geometry:
             point[1] + self.raw_point_shift[1],
         )
 
+    @traced
     def _make_static_geometry(
         self,
         contours,
@@ -653,11 +659,28 @@ class Geometry:
                         contours.append(interior.coords)
         return self._tess.make_indexed_vertices_from_contours(contours)
 
+    @traced
     def add_sticky(self, sticky):
         self._stickies_indexed_vertices.append(
             (sticky, self._make_sticky_indexed_vertices(sticky))
         )
 
+    # Preview stickies are kept by their joined wall, so that the mesh is only
+    # made again when the hovered wall changes.
+    def _get_preview_sticky_indexed_vertices(self, sticky):
+        key = (tuple(sticky.wall), sticky.is_exterior)
+        if key in self._preview_sticky_indexed_vertices:
+            self._preview_sticky_indexed_vertices.move_to_end(key)
+            return self._preview_sticky_indexed_vertices[key]
+        indexed_vertices = self._make_sticky_indexed_vertices(sticky)
+        self._preview_sticky_indexed_vertices[key] = indexed_vertices
+        if len(self._preview_sticky_indexed_vertices) > MAX_CACHED_PREVIEW_STICKIES:
+            _, old_indexed_vertices = self._preview_sticky_indexed_vertices.popitem(
+                last=False
+            )
+            old_indexed_vertices.dispose()
+        return indexed_vertices
+
     def remove_sticky(self, sticky):
         for i, (existing_sticky, existing_sticky_indexed_vertices) in enumerate(
             self._stickies_indexed_vertices
@@ -669,14 +692,19 @@ class Geometry:
         else:
             raise Exception("Tried removing a sticky that does not exist.")
 
-    def render(self, camera, physics, framebuffer):
+    # Alpha is how far between the last two physics updates the frame is drawn.
+    @traced
+    def render(self, camera, physics, framebuffer, alpha):
+        snapshot = physics.get_snapshot(alpha)
         if framebuffer is not None:
             gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, framebuffer.fbo)
+        gpu_profiler().begin_pass("clear")
         clear_gl(self._bg_color)
 
         camera_matrix = camera.get_matrix()
         view_matrix = [camera_matrix.column(i) for i in range(4)]
 
+        gpu_profiler().begin_pass("ground")
         single_color_shader.use()
         # pylint: disable=assigning-non-slot
         single_color_shader.uniforms.u_view_matrix = view_matrix
@@ -690,6 +718,7 @@ class Geometry:
         )
         single_color_shader.clear()
 
+        gpu_profiler().begin_pass("sand")
         if self._sand_pits_indexed_vertices:
             single_color_with_gradient_texture_shader.use()
             # pylint: disable=assigning-non-slot
@@ -770,6 +799,7 @@ class Geometry:
             else:
                 raise Exception("Unknown platform buffer type")
 
+        gpu_profiler().begin_pass("platforms")
         render_platform(
             self._unbuffed_platform, self._unbuffed_platform_indexed_vertices
         )
@@ -777,6 +807,7 @@ class Geometry:
         for buff, indexed_vertices in self._buffed_platform_indexed_vertices:
             render_platform(buff, indexed_vertices)
 
+        gpu_profiler().begin_pass("walls")
         if self._is_closed_in:
             rectangles = list(camera.get_view_rect().subtract(self.exterior_rect))
             if len(rectangles) > 0:
@@ -812,6 +843,7 @@ class Geometry:
         def make_stripe_line(angle):
             return (math.sin(angle), -math.cos(angle), 0)
 
+        gpu_profiler().begin_pass("flats")
         stripe_shader.use()
         # pylint: disable=assigning-non-slot
         stripe_shader.uniforms.u_view_matrix = view_matrix
@@ -831,10 +863,11 @@ class Geometry:
         self._flag_flat_indexed_vertices.render(
             stripe_shader.attributes.a_vertex_position
         )
+        gpu_profiler().begin_pass("stickies")
         sticky = physics.get_preview_sticky()
         if sticky:
             joined_sticky = add_sticky_to_stickies(physics.existing_stickies, sticky)[1]
-            indexed_vertices = self._make_sticky_indexed_vertices(joined_sticky)
+            indexed_vertices = self._get_preview_sticky_indexed_vertices(joined_sticky)
             # pylint: disable=assigning-non-slot
             stripe_shader.uniforms.u_view_matrix = view_matrix
             stripe_shader.uniforms.u_line = make_stripe_line(
@@ -854,7 +887,6 @@ class Geometry:
             )
             # pylint: enable=assigning-non-slot
             indexed_vertices.render(stripe_shader.attributes.a_vertex_position)
-            indexed_vertices.dispose()
         for _, sticky_indexed_vertices in self._stickies_indexed_vertices:
             # pylint: disable=assigning-non-slot
             stripe_shader.uniforms.u_view_matrix = view_matrix
@@ -921,6 +953,7 @@ class Geometry:
             vertices.append(outer_circle[0][1])
             return vertices
 
+        gpu_profiler().begin_pass("shot_preview")
         if physics.is_dragging:
             drag_velocity = physics.get_drag_velocity()
             vel_y_sign = 1 if drag_velocity.y > 0 else -1
@@ -932,12 +965,20 @@ class Geometry:
                 drag_velocity.x,
                 drag_velocity.y * (1 - vel_y_sign * self._shot_preview_lerp_down),
             )
-            path1 = physics.simulate_ball_path_from_position_with_velocity(
-                physics.ball_position + Vec2(0, physics.ball_radius), vel1
-            )
-            path2 = physics.simulate_ball_path_from_position_with_velocity(
-                physics.ball_position - Vec2(0, physics.ball_radius), vel2
-            )
+            # Both paths start from the ball itself, as the preview collides with
+            # the walls, and are then moved to the top and bottom of the ball.
+            path1 = [
+                c + Vec2(0, physics.ball_radius)
+                for c in physics.simulate_ball_path_from_position_with_velocity(
+                    snapshot.ball_position, vel1
+                )
+            ]
+            path2 = [
+                c - Vec2(0, physics.ball_radius)
+                for c in physics.simulate_ball_path_from_position_with_velocity(
+                    snapshot.ball_position, vel2
+                )
+            ]
             verts1, dists1, dist1 = update_dynamic_shot_preview_dotted_line_buffers(
                 0, path1
             )
@@ -1058,7 +1099,8 @@ class Geometry:
             gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, (CIRCLE_POINTS + 1) * 2)
             single_color_shader.clear()
 
-        trail = physics.get_ball_trail()
+        gpu_profiler().begin_pass("trail")
+        trail = physics.get_ball_trail(snapshot)
         if len(trail) > 1:
             ball_trail_verts = []
             ball_trail_dists = []
@@ -1094,12 +1136,13 @@ class Geometry:
             gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, len(trail) * 2)
             faded_color_shader.clear()
 
+        gpu_profiler().begin_pass("ball")
         assert physics.ball_radius > self._ball_outline_size
         ball_outer_circle = make_circle(
-            physics.ball_position, physics.ball_radius, CIRCLE_POINTS
+            snapshot.ball_position, physics.ball_radius, CIRCLE_POINTS
         )
         ball_inner_circle = make_circle(
-            physics.ball_position,
+            snapshot.ball_position,
             physics.ball_radius - self._ball_outline_size,
             CIRCLE_POINTS,
         )
@@ -1142,6 +1185,7 @@ class Geometry:
             )
             sprite.draw()
 
+        gpu_profiler().begin_pass("flag")
         draw_sprite(
             self._flag_sprite,
             self._flag_img,
@@ -1150,6 +1194,7 @@ class Geometry:
             self._flag_height,
         )
 
+        gpu_profiler().end_pass()
         if framebuffer is not None:
             gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
@@ -1185,6 +1230,9 @@ class Geometry:
         for _, indexed_vertices in self._stickies_indexed_vertices:
             indexed_vertices.dispose()
         self._stickies_indexed_vertices = None
+        for indexed_vertices in self._preview_sticky_indexed_vertices.values():
+            indexed_vertices.dispose()
+        self._preview_sticky_indexed_vertices = None
         self._dynamic_ball_trail_polygon_vertex_buffer.dispose()
         self._dynamic_ball_trail_polygon_vertex_buffer = None
         self._dynamic_ball_trail_polygon_distance_buffer.dispose()
@@ -0,0 +1,152 @@
+import ctypes
+from pyglet import gl
+from pyglet.gl import gl_info, glext_arb
+from config import config
+
+
+class _FrameQueries:
+    def __init__(self, queries):
+        self.queries = queries
+        # The pass starting at each query, or None where a pass ends without
+        # another starting.
+        self.pass_names = []
+
+
+# Times render passes on the GPU with GL_ARB_timer_query. Passes follow one
+# another, so each begin_pass ends the last one, and a timestamp is written into
+# the command stream at every boundary between them. The GPU runs a frame or
+# two behind the CPU, so each frame's queries are only read num_buffered_frames
+# frames later, when they are reused, and a frame whose results aren't in yet
+# is dropped rather than waited for.
+class GpuProfiler:
+    def __init__(self, num_buffered_frames, max_queries_per_frame):
+        self._num_buffered_frames = num_buffered_frames
+        self._max_queries_per_frame = max_queries_per_frame
+        self._frames = None
+        self._frame_idx = 0
+        self._is_recording = False
+        self._should_be_enabled = False
+        self.num_dropped_frames = 0
+
+    @property
+    def is_enabled(self):
+        return self._frames is not None
+
+    @staticmethod
+    def is_supported():
+        return gl_info.have_extension("GL_ARB_timer_query") or gl_info.have_version(
+            3, 3
+        )
+
+    # Takes effect from the next frame, so that no frame is half measured.
+    def set_is_enabled(self, is_enabled):
+        self._should_be_enabled = is_enabled
+
+    def _create_queries(self):
+        self._frames = []
+        for _ in range(self._num_buffered_frames):
+            queries = (gl.GLuint * self._max_queries_per_frame)()
+            gl.glGenQueries(self._max_queries_per_frame, queries)
+            self._frames.append(_FrameQueries(queries))
+        self._frame_idx = 0
+
+    def _delete_queries(self):
+        for frame in self._frames:
+            gl.glDeleteQueries(self._max_queries_per_frame, frame.queries)
+        self._frames = None
+
+    # The GPU milliseconds each pass took, added up over the passes with the
+    # same name, or None if the results aren't in yet.
+    def _read_frame(self, frame):
+        if len(frame.pass_names) < 2:
+            return None
+        available = gl.GLint()
+        gl.glGetQueryObjectiv(
+            frame.queries[len(frame.pass_names) - 1],
+            gl.GL_QUERY_RESULT_AVAILABLE,
+            ctypes.byref(available),
+        )
+        if not available.value:
+            self.num_dropped_frames += 1
+            return None
+        timestamps = []
+        timestamp = gl.GLuint64()
+        for i in range(len(frame.pass_names)):
+            glext_arb.glGetQueryObjectui64v(
+                frame.queries[i], gl.GL_QUERY_RESULT, ctypes.byref(timestamp)
+            )
+            timestamps.append(timestamp.value)
+        pass_times = {}
+        for i, name in enumerate(frame.pass_names[:-1]):
+            if name is not None:
+                pass_times[name] = (
+                    pass_times.get(name, 0) + (timestamps[i + 1] - timestamps[i]) / 1e6
+                )
+        return pass_times
+
+    # Starts measuring a frame, and returns the pass times of the frame
+    # num_buffered_frames ago, or None if there are none.
+    def begin_frame(self):
+        if self._should_be_enabled and not self.is_enabled:
+            if not self.is_supported():
+                print("GPU profiling needs GL_ARB_timer_query")
+                self._should_be_enabled = False
+                return None
+            self._create_queries()
+        elif not self._should_be_enabled and self.is_enabled:
+            self._delete_queries()
+        if not self.is_enabled:
+            return None
+        frame = self._frames[self._frame_idx]
+        pass_times = self._read_frame(frame)
+        frame.pass_names = []
+        self._is_recording = True
+        return pass_times
+
+    def _write_timestamp(self, name):
+        frame = self._frames[self._frame_idx]
+        if len(frame.pass_names) == self._max_queries_per_frame:
+            return
+        glext_arb.glQueryCounter(
+            frame.queries[len(frame.pass_names)], glext_arb.GL_TIMESTAMP
+        )
+        frame.pass_names.append(name)
+
+    # Ends the pass being measured, if there is one, and starts measuring the
+    # pass named name.
+    def begin_pass(self, name):
+        if self._is_recording:
+            self._write_timestamp(name)
+
+    def end_pass(self):
+        if not self._is_recording:
+            return
+        pass_names = self._frames[self._frame_idx].pass_names
+        if pass_names and pass_names[-1] is not None:
+            self._write_timestamp(None)
+
+    def end_frame(self):
+        if not self._is_recording:
+            return
+        self.end_pass()
+        self._is_recording = False
+        self._frame_idx = (self._frame_idx + 1) % self._num_buffered_frames
+
+    def dispose(self):
+        if self.is_enabled:
+            self._delete_queries()
+        self._is_recording = False
+
+
+_gpu_profiler = None
+
+
+def gpu_profiler():
+    # pylint: disable-next=global-statement
+    global _gpu_profiler
+    if _gpu_profiler is None:
+        _gpu_profiler = GpuProfiler(
+            num_buffered_frames=config().gpu_profiler_buffered_frames,
+            max_queries_per_frame=64,
+        )
+    return _gpu_profiler
@@ -0,0 +1,318 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
+import numpy as np
+import pyglet
+from config import config
+from headless_physics import make_headless_physics
+from shot_check import find_shots_reaching_flag
+from tracing import get_traced_result, span, submit_traced
+
+
+class HoleSolution:
+    def __init__(self, par):
+        # The fewest shots to the flag found, or None if it takes more than
+        # max_par.
+        self.par = par
+
+
+class _SolutionRequest:
+    def __init__(self, key, on_solution):
+        self.key = key
+        self.on_solution = on_solution
+
+
+# A breadth first search over where shots come to rest. Each level shoots every
+# shot velocity from every position in the frontier, and the positions shots
+# come to rest in make up the next frontier, closest to the flag first.
+class _Search:
+    def __init__(
+        self, simulator, start, shot_velocities, num_updates, check_args, on_done
+    ):
+        self.simulator = simulator
+        self.shot_velocities = shot_velocities
+        self.num_updates = num_updates
+        # The arguments find_shots_reaching_flag takes before the shots.
+        self.check_args = check_args
+        self.on_done = on_done
+        self.num_shots = 0
+        # Pairs of a position and the shots which led to it.
+        self.frontier = [((start[0], start[1]), ())]
+        self.visited = set()
+        self.next_frontier = []
+        self.tasks = []
+        # Shots which reach the flag in BatchSimulator, waiting to be checked.
+        self.candidates = []
+        self.check_task = None
+
+
+# Works out the par of holes by searching the shots the player could take with
+# BatchSimulator. Each level of a search is split into tasks of a few positions
+# which run in worker processes. BatchSimulator only approximates Physics, so
+# shots it finds reaching the flag are played through Physics in a worker too,
+# a few at a time, and as soon as some do the rest of the search is cancelled.
+# A hole's par is the fewest shots found this way. Results are polled for from
+# the clock and handed back on the main thread, and solutions are kept by cave
+# seed so that asking for a hole's par again, or after prefetching it, is
+# instant.
+class HoleSolver:
+    def __init__(
+        self,
+        num_processes,
+        poll_interval,
+        max_par,
+        num_shot_angles,
+        num_shot_powers,
+        max_frontier,
+        positions_per_task,
+        candidates_per_task,
+        max_shot_seconds,
+    ):
+        self._num_processes = num_processes
+        self._poll_interval = poll_interval
+        self._max_par = max_par
+        self._num_shot_angles = num_shot_angles
+        self._num_shot_powers = num_shot_powers
+        self._max_frontier = max_frontier
+        self._positions_per_task = positions_per_task
+        self._candidates_per_task = candidates_per_task
+        self._max_shot_seconds = max_shot_seconds
+        self._executor = None
+        self._searches = []
+        self._solutions = {}
+        self._solution_searches = {}
+        self._requests = []
+        self._is_polling = False
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Spawned rather than forked, as forking copies the window, the GL
+            # context and the audio threads into every worker.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._num_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    # Shots in every direction, with powers evenly spread up to max_power and
+    # rounded to what a whole number of pixels of drag gives.
+    def _get_shot_velocities(self, physics_settings):
+        max_power = physics_settings["max_power"]
+        shot_sensitivity = physics_settings["shot_sensitivity"]
+        velocities = []
+        for i in range(self._num_shot_angles):
+            angle = 2 * math.pi * i / self._num_shot_angles
+            for j in range(self._num_shot_powers):
+                power = max_power * (j + 1) / self._num_shot_powers
+                power = max(round(power / shot_sensitivity), 1) * shot_sensitivity
+                velocities.append((math.cos(angle) * power, math.sin(angle) * power))
+        return velocities
+
+    def _start_search(self, simulator, start, physics_settings, check_args, on_done):
+        search = _Search(
+            simulator=simulator,
+            start=start,
+            shot_velocities=self._get_shot_velocities(physics_settings),
+            num_updates=round(self._max_shot_seconds / simulator.dt),
+            check_args=check_args,
+            on_done=on_done,
+        )
+        self._searches.append(search)
+        self._start_level(search)
+        self._update_polling()
+        return search
+
+    def _start_level(self, search):
+        search.num_shots += 1
+        search.next_frontier = []
+        search.tasks = []
+        velocities = search.shot_velocities
+        for i in range(0, len(search.frontier), self._positions_per_task):
+            entries = search.frontier[i : i + self._positions_per_task]
+            future = submit_traced(
+                self._get_executor(),
+                search.simulator.simulate,
+                [position for position, _ in entries for _ in velocities],
+                velocities * len(entries),
+                search.num_updates,
+                False,
+            )
+            search.tasks.append((future, entries))
+
+    def _finish_search(self, search, solution):
+        for future, _ in search.tasks:
+            future.cancel()
+        if search.check_task is not None:
+            search.check_task[0].cancel()
+        self._searches.remove(search)
+        search.on_done(solution)
+
+    def _advance_search(self, search):
+        if search.check_task is not None and search.check_task[0].done():
+            future, shot_sequences = search.check_task
+            search.check_task = None
+            reached = get_traced_result(future)
+            if reached is not None:
+                self._finish_search(search, HoleSolution(reached[1]))
+                return
+        velocities = search.shot_velocities
+        for future, entries in [task for task in search.tasks if task[0].done()]:
+            search.tasks.remove((future, entries))
+            paths = get_traced_result(future)
+            for i in np.flatnonzero(paths.reached_flag):
+                entry_idx, velocity_idx = divmod(i, len(velocities))
+                search.candidates.append(
+                    entries[entry_idx][1] + (velocities[velocity_idx],)
+                )
+            for i in np.flatnonzero(paths.rest_update_nums >= 0):
+                entry_idx, velocity_idx = divmod(i, len(velocities))
+                search.next_frontier.append(
+                    (
+                        tuple(paths.end_positions[i]),
+                        entries[entry_idx][1] + (velocities[velocity_idx],),
+                    )
+                )
+        if search.candidates and search.check_task is None:
+            shot_sequences = search.candidates[: self._candidates_per_task]
+            del search.candidates[: self._candidates_per_task]
+            future = submit_traced(
+                self._get_executor(),
+                find_shots_reaching_flag,
+                *search.check_args,
+                shot_sequences,
+                search.num_updates,
+            )
+            search.check_task = (future, shot_sequences)
+        if search.tasks or search.check_task is not None:
+            return
+        if search.num_shots == self._max_par:
+            self._finish_search(search, HoleSolution(None))
+            return
+        # Positions within half a unit of one another are searched once.
+        frontier = []
+        for position, shots in search.next_frontier:
+            key = (round(position[0] * 2), round(position[1] * 2))
+            if key not in search.visited:
+                search.visited.add(key)
+                frontier.append((position, shots))
+        flag_position = search.simulator.flag_position
+        frontier.sort(
+            key=lambda entry: (entry[0][0] - flag_position[0]) ** 2
+            + (entry[0][1] - flag_position[1]) ** 2
+        )
+        search.frontier = frontier[: self._max_frontier]
+        if not search.frontier:
+            self._finish_search(search, HoleSolution(None))
+            return
+        self._start_level(search)
+
+    def _get_solution_key(self, cave, cave_args, updates_per_second, physics_settings):
+        return (
+            cave.seed,
+            tuple(cave_args),
+            updates_per_second,
+            tuple(sorted((k, str(v)) for k, v in physics_settings.items())),
+        )
+
+    # Starts solving the hole if it hasn't been already.
+    def prefetch(self, cave, cave_args, updates_per_second, physics_settings):
+        key = self._get_solution_key(
+            cave, cave_args, updates_per_second, physics_settings
+        )
+        if key in self._solutions or key in self._solution_searches:
+            return key
+        physics = make_headless_physics(
+            cave,
+            point_shift=(0, 0),
+            updates_per_second=updates_per_second,
+            physics_settings=physics_settings,
+        )
+
+        # Vec2s can't be sent to the worker processes.
+        check_settings = dict(physics_settings)
+        check_settings["gravity"] = tuple(physics_settings["gravity"])
+
+        def on_done(solution):
+            del self._solution_searches[key]
+            self._solutions[key] = solution
+            for request in [r for r in self._requests if r.key == key]:
+                self._requests.remove(request)
+                request.on_solution(solution)
+
+        self._solution_searches[key] = self._start_search(
+            physics.make_batch_simulator(),
+            physics.ball_position,
+            physics_settings,
+            (cave, updates_per_second, check_settings),
+            on_done,
+        )
+        physics.dispose()
+        return key
+
+    # Calls on_solution with the hole's solution on the main thread, straight
+    # away if it has been solved before. Returns a request which can be passed
+    # to cancel_request.
+    def request_solution(
+        self, cave, cave_args, updates_per_second, physics_settings, on_solution
+    ):
+        key = self.prefetch(cave, cave_args, updates_per_second, physics_settings)
+        if key in self._solutions:
+            on_solution(self._solutions[key])
+            return None
+        request = _SolutionRequest(key, on_solution)
+        self._requests.append(request)
+        return request
+
+    # The search carries on so that the solution is cached for later.
+    def cancel_request(self, request):
+        if request in self._requests:
+            self._requests.remove(request)
+
+    def _poll(self, _dt):
+        with span("HoleSolver._poll"):
+            for search in list(self._searches):
+                self._advance_search(search)
+        self._update_polling()
+
+    def _update_polling(self):
+        should_poll = len(self._searches) > 0
+        if should_poll and not self._is_polling:
+            pyglet.clock.schedule_interval(self._poll, self._poll_interval)
+        elif not should_poll and self._is_polling:
+            pyglet.clock.unschedule(self._poll)
+        self._is_polling = should_poll
+
+    def shutdown(self):
+        for search in list(self._searches):
+            for future, _ in search.tasks:
+                future.cancel()
+            if search.check_task is not None:
+                search.check_task[0].cancel()
+        self._searches = []
+        self._solution_searches = {}
+        self._requests = []
+        self._update_polling()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_hole_solver = None
+
+
+def hole_solver():
+    # pylint: disable-next=global-statement
+    global _hole_solver
+    if _hole_solver is None:
+        _hole_solver = HoleSolver(
+            num_processes=config().hole_solver_processes,
+            poll_interval=config().hole_solver_poll_interval,
+            max_par=5,
+            num_shot_angles=32,
+            num_shot_powers=8,
+            max_frontier=24,
+            positions_per_task=2,
+            candidates_per_task=4,
+            max_shot_seconds=8,
+        )
+    return _hole_solver
@@ -0,0 +1,55 @@
+# Input sources feed mouse and key events to Physics. Handlers are the pyglet
+# window event handlers (on_mouse_press, on_mouse_drag, on_mouse_release,
+# on_key_release and on_mouse_motion), passed by name to bind. poll is called at
+# the start of every physics update.
+
+
+# Forwards the events of a pyglet window.
+class WindowInputSource:
+    def __init__(self, window):
+        self._window = window
+
+    def bind(self, **handlers):
+        self._window.push_handlers(**handlers)
+
+    def unbind(self):
+        self._window.pop_handlers()
+
+    def poll(self):
+        pass
+
+
+# Plays back a fixed list of (update number, event name, event args) events, so
+# that Physics can be driven without a window. Each event is dispatched at the
+# start of the update with its number, counting from 0. Events can also be
+# dispatched straight away with dispatch.
+class ScriptedInputSource:
+    def __init__(self, events=()):
+        self._events = sorted(events, key=lambda event: event[0])
+        self._next_event_idx = 0
+        self._update_num = 0
+        self._handlers = None
+
+    def bind(self, **handlers):
+        self._handlers = handlers
+
+    def unbind(self):
+        self._handlers = None
+
+    @property
+    def is_done(self):
+        return self._next_event_idx == len(self._events)
+
+    def dispatch(self, name, *args):
+        if self._handlers is not None and name in self._handlers:
+            self._handlers[name](*args)
+
+    def poll(self):
+        while (
+            self._next_event_idx < len(self._events)
+            and self._events[self._next_event_idx][0] <= self._update_num
+        ):
+            _, name, args = self._events[self._next_event_idx]
+            self._next_event_idx += 1
+            self.dispatch(name, *args)
+        self._update_num += 1
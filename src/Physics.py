@@ -1,11 +1,21 @@
+from collections import OrderedDict
 from enum import Enum, auto
 from time import time
 import math
+import statistics
 import pyglet
 from pyglet.math import Vec2
 from pyglet.window import key
 import pymunk
 from config import config
+from tracing import span, traced
+from BatchSimulator import (
+    BatchSimulator,
+    BatchSegment,
+    SEGMENT_NORMAL,
+    SEGMENT_SAND,
+    SEGMENT_STICKY,
+)
 
 
 class _MouseDraggingState(Enum):
@@ -46,6 +56,29 @@ class Sticky:
         self.is_preview = is_preview
 
 
+# Ways pymunk can find which shapes might touch. Chipmunk's bounding box tree
+# needs no tuning, while a spatial hash can be faster for many shapes of about
+# the same size, which cave contours are made of.
+BROADPHASES = ["bb_tree", "spatial_hash"]
+
+
+# Spatial hash cells are twice the size of the median segment, so that most
+# segments fall into a single cell. Chipmunk suggests ten cells for every shape,
+# but the ball's hash has as many cells as the segments' one and all of them are
+# cleared every step, which with that many cells costs more than the segments
+# take to find. One cell for every ten segments measured best in bench_physics.
+def _use_broadphase(space, broadphase):
+    if broadphase not in BROADPHASES:
+        raise ValueError(f"unknown broadphase {broadphase!r}")
+    if broadphase == "spatial_hash":
+        segments = [s for s in space.shapes if isinstance(s, pymunk.Segment)]
+        cell_size = 2 * statistics.median(
+            max(abs(s.b[0] - s.a[0]), abs(s.b[1] - s.a[1])) + 2 * s.radius
+            for s in segments
+        )
+        space.use_spatial_hash(cell_size, max(len(segments) // 10, 1))
+
+
 def _encode_segment_coords(c1, c2):
     if c1 < c2:
         return (c1[0], c1[1], c2[0], c2[1])
@@ -59,10 +92,79 @@ class _ContourSegmentType(Enum):
     STICKY = auto()
 
 
+# The shapes of a segment of the simplified contours, which stand for every
+# segment of the original contour in its run, from its start to its end point.
 class _ContourSegment:
-    def __init__(self, pymunk_shape, seg_type):
+    def __init__(self, pymunk_shape, preview_pymunk_shape, seg_type, run):
         self.pymunk_shape = pymunk_shape
+        self.preview_pymunk_shape = preview_pymunk_shape
         self.seg_type = seg_type
+        self.run = run
+
+
+# A uniform grid of the contour segments that stickies can be placed on, so
+# that finding the segments near a point only looks at the nearby cells. Each
+# segment is stored as (contour index, segment index) in every cell its
+# bounding box overlaps, and is removed by its encoded coords.
+class _ContourSegmentGrid:
+    def __init__(self, cell_size):
+        self._cell_size = cell_size
+        self._cells = {}
+        self._segment_cells = {}
+
+    def _get_cell_range(self, min_x, min_y, max_x, max_y):
+        return (
+            range(
+                math.floor(min_x / self._cell_size),
+                math.floor(max_x / self._cell_size) + 1,
+            ),
+            range(
+                math.floor(min_y / self._cell_size),
+                math.floor(max_y / self._cell_size) + 1,
+            ),
+        )
+
+    # do_circle_and_line_segment_intersect also accepts circles up to one
+    # segment length behind c1, so the segment's cells cover that too.
+    def add(self, seg_key, segment, c1, c2):
+        c0 = (2 * c1[0] - c2[0], 2 * c1[1] - c2[1])
+        cell_xs, cell_ys = self._get_cell_range(
+            min(c0[0], c2[0]), min(c0[1], c2[1]), max(c0[0], c2[0]), max(c0[1], c2[1])
+        )
+        cells = [(x, y) for x in cell_xs for y in cell_ys]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(segment)
+        self._segment_cells[seg_key] = (segment, cells)
+
+    def remove(self, seg_key):
+        if seg_key not in self._segment_cells:
+            return
+        segment, cells = self._segment_cells.pop(seg_key)
+        for cell in cells:
+            self._cells[cell].discard(segment)
+
+    # The segments whose bounding boxes may be within distance of position, in
+    # contour then segment order.
+    def query(self, position, distance):
+        cell_xs, cell_ys = self._get_cell_range(
+            position[0] - distance,
+            position[1] - distance,
+            position[0] + distance,
+            position[1] + distance,
+        )
+        segments = set()
+        for x in cell_xs:
+            for y in cell_ys:
+                segments.update(self._cells.get((x, y), ()))
+        return sorted(segments)
+
+
+# Each update is split into enough substeps that the ball never moves further
+# than max_step_distance in one, so that fast shots can't pass through walls
+# however low the update rate is.
+def _get_num_substeps(velocity, dt, max_step_distance):
+    speed = math.sqrt(velocity[0] ** 2 + velocity[1] ** 2)
+    return max(1, math.ceil(speed * dt / max_step_distance))
 
 
 _default_collision_type = 0
@@ -72,6 +174,109 @@ _sticky_collision_type = 3
 _flag_collision_type = 4
 
 
+# Simulates the ball's path for the shot preview in a space of its own, which
+# holds a copy of every static segment and lives for the whole hole. Launch
+# velocities are quantised so that small jitters in the drag don't cause a new
+# simulation, and the last few paths are cached.
+class _ShotPreview:
+    max_cached_paths = 4
+
+    def __init__(
+        self,
+        gravity,
+        num_updates,
+        dt,
+        max_ball_step_distance,
+        velocity_quantum,
+    ):
+        self.space = pymunk.Space()
+        self._gravity = gravity
+        self._num_updates = num_updates
+        self._dt = dt
+        self._max_ball_step_distance = max_ball_step_distance
+        self._velocity_quantum = velocity_quantum
+        self._ball_shape = None
+        self._paths = OrderedDict()
+        ball_sticky_collision_handler = self.space.add_collision_handler(
+            _ball_collision_type, _sticky_collision_type
+        )
+        ball_sticky_collision_handler.begin = self._on_ball_sticky_collision
+
+    def _on_ball_sticky_collision(self, _arb, _space, _data):
+        self.space.gravity = (0, 0)
+        self._ball_shape.body.velocity = (0, 0)
+        return True
+
+    def add_segment(self, shape):
+        preview_shape = pymunk.Segment(
+            self.space.static_body, shape.a, shape.b, shape.radius
+        )
+        preview_shape.friction = shape.friction
+        preview_shape.elasticity = shape.elasticity
+        preview_shape.collision_type = shape.collision_type
+        self.space.add(preview_shape)
+        return preview_shape
+
+    def remove_segment(self, preview_shape):
+        self.space.remove(preview_shape)
+
+    # Must be called whenever the segments change.
+    def clear_cache(self):
+        self._paths.clear()
+
+    # Rounds the velocity to a multiple of velocity_quantum, as the paths are
+    # simulated for and cached by. Shots dragged by the player are rounded too,
+    # so that they take exactly the path which was previewed.
+    def quantise_velocity(self, velocity):
+        return Vec2(
+            round(velocity[0] / self._velocity_quantum) * self._velocity_quantum,
+            round(velocity[1] / self._velocity_quantum) * self._velocity_quantum,
+        )
+
+    def simulate_ball_path(self, ball_shape, position, velocity):
+        velocity = self.quantise_velocity(velocity)
+        key = (position[0], position[1], velocity.x, velocity.y)
+        if key in self._paths:
+            self._paths.move_to_end(key)
+            return self._paths[key]
+
+        # A new ball for every simulation, as the solver keeps state on the
+        # ball's body which would otherwise make the same launch take a
+        # different path depending on what was simulated before it. It is
+        # added at rest and only then given its velocity, like the real ball
+        # when a shot is taken, because the space's bounding box tree pads a
+        # shape's box by its velocity when it is added, which changes the order
+        # contacts are solved in.
+        if self._ball_shape is not None:
+            self.space.remove(self._ball_shape.body, self._ball_shape)
+        body = pymunk.Body(ball_shape.body.mass, ball_shape.body.moment)
+        self._ball_shape = pymunk.Circle(body, ball_shape.radius)
+        self._ball_shape.friction = ball_shape.friction
+        self._ball_shape.elasticity = ball_shape.elasticity
+        self._ball_shape.collision_type = ball_shape.collision_type
+        body.position = position
+        self.space.add(body, self._ball_shape)
+        body.velocity = velocity
+        self.space.gravity = self._gravity
+        positions = [Vec2(position[0], position[1])]
+        for _ in range(self._num_updates):
+            num_substeps = _get_num_substeps(
+                body.velocity, self._dt, self._max_ball_step_distance
+            )
+            for _ in range(num_substeps):
+                self.space.step(self._dt / num_substeps)
+            positions.append(Vec2(body.position[0], body.position[1]))
+            if body.velocity.get_length_sqrd() < 0.000000001:
+                # The ball has come to rest, so it won't move any more.
+                positions += [positions[-1]] * (self._num_updates + 1 - len(positions))
+                break
+
+        self._paths[key] = positions
+        if len(self._paths) > self.max_cached_paths:
+            self._paths.popitem(last=False)
+        return positions
+
+
 def add_sticky_to_stickies(stickies, sticky):
     new_stickies = []
     removed_stickies = []
@@ -125,13 +330,47 @@ def do_circle_and_line_segment_intersect(
     return d <= circle_radius
 
 
+# What is drawn of the ball after an update. Physics keeps the last two so that
+# frames drawn between updates can be interpolated between them. One is taken
+# every update, so it only keeps references to what pymunk and Physics already
+# made, and the ball's trail is worked out once per frame instead.
+class PhysicsSnapshot:
+    def __init__(self, ball_position, ball_velocity, ball_trail_points, is_resting):
+        self.ball_position = ball_position
+        self.ball_velocity = ball_velocity
+        self.ball_trail_points = ball_trail_points
+        self.is_resting = is_resting
+
+    # Alpha is how far it is from the previous snapshot to this one.
+    def interpolate(self, previous, alpha):
+        position = self.ball_position
+        velocity = self.ball_velocity
+        if alpha < 1 and self is not previous:
+            position = (
+                previous.ball_position + (position - previous.ball_position) * alpha
+            )
+            velocity = (
+                previous.ball_velocity + (velocity - previous.ball_velocity) * alpha
+            )
+        return PhysicsSnapshot(
+            ball_position=Vec2(position[0], position[1]),
+            ball_velocity=Vec2(velocity[0], velocity[1]),
+            ball_trail_points=self.ball_trail_points,
+            is_resting=self.is_resting,
+        )
+
+
 class Physics:
+    @traced
     def __init__(
         self,
-        game,
+        updates_per_second,
+        input_source,
         camera,
         contours,
         exterior_contour,
+        contour_runs,
+        exterior_contour_runs,
         sand_pits,
         ball_position,
         ball_radius,
@@ -141,6 +380,8 @@ class Physics:
         flag_position,
         flag_collision_shape_radius,
         shot_preview_simulation_updates,
+        shot_preview_velocity_quantum,
+        max_ball_step_distance,
         updates_per_new_ball_trail_point,
         num_ball_trail_points,
         ball_trail_width,
@@ -156,8 +397,10 @@ class Physics:
         get_is_paused,
         on_ball_sticky_collision,
         on_ball_sand_collision,
+        recorder,
+        broadphase,
     ):
-        self._game = game
+        self._input_source = input_source
         self._camera = camera
         self._space = pymunk.Space()
         self._space.gravity = gravity
@@ -169,11 +412,20 @@ class Physics:
         self._max_power = max_power
         self._shot_sensitivity = shot_sensitivity
         self._gravity = gravity
+        self._max_ball_step_distance = max_ball_step_distance
         self._flag_position = flag_position
+        self._flag_collision_shape_radius = flag_collision_shape_radius
+        self._updates_per_second = updates_per_second
         self._mouse_dragging = None
         self._canceled_shot = False
         self._has_pressed_mouse_in_current_mode = False
-        self._shot_preview_simulation_updates = shot_preview_simulation_updates
+        self._shot_preview = _ShotPreview(
+            gravity=gravity,
+            num_updates=shot_preview_simulation_updates,
+            dt=1 / updates_per_second,
+            max_ball_step_distance=max_ball_step_distance,
+            velocity_quantum=shot_preview_velocity_quantum,
+        )
         self.shot_number = 0
         self._updates_per_new_ball_trail_point = updates_per_new_ball_trail_point
         self._updates_until_new_ball_trail_point = 0
@@ -187,9 +439,12 @@ class Physics:
         self._stickies = []
         self._on_new_sticky = on_new_sticky
         self._on_sticky_removed = on_sticky_removed
-        self._contours = contours
-        self._exterior_contour = exterior_contour
+        # Stickies are placed on the original contours, which the runs of the
+        # simplified ones join back into.
+        self._contours = [[p for run in runs for p in run] for runs in contour_runs]
+        self._exterior_contour = [p for run in exterior_contour_runs for p in run]
         self._contour_segment_map = {}
+        self._sticky_segment_grid = _ContourSegmentGrid(cell_size=sticky_radius)
         self._on_hole_animation_done = on_hole_animation_done
         self._hole_animation_start_time = None
         self._hole_animation_start_pos = None
@@ -203,21 +458,36 @@ class Physics:
         self._did_unbind_events = False
         self._on_ball_sticky_collision_cb = on_ball_sticky_collision
         self._on_ball_sand_collision_cb = on_ball_sand_collision
+        self._recorder = recorder
+        self._shot_velocity = None
+        self.update_num = 0
 
-        for contour_idx, contour in enumerate([exterior_contour] + contours):
+        simplified_segments = {}
+        for contour_idx, (contour, runs) in enumerate(
+            zip(
+                [exterior_contour] + contours,
+                [exterior_contour_runs] + contour_runs,
+            )
+        ):
             for i, p1 in enumerate(contour):
                 p2 = contour[(i + 1) % len(contour)]
-                r = 0.1
-                if contour_idx == 0:
-                    shape = pymunk.Segment(self._space.static_body, p1, p2, r)
-                else:
-                    shape = pymunk.Segment(self._space.static_body, p2, p1, r)
-                shape.friction = self._friction
-                shape.elasticity = self._elasticity
-                self._space.add(shape)
-                self._contour_segment_map[
-                    _encode_segment_coords(p1, p2)
-                ] = _ContourSegment(shape, _ContourSegmentType.NORMAL)
+                segment = self._add_contour_segment(
+                    p1, p2, runs[i] + [p2], is_exterior=contour_idx == 0
+                )
+                simplified_segments[_encode_segment_coords(p1, p2)] = segment
+        for contour_idx, contour in enumerate(
+            [self._exterior_contour] + self._contours
+        ):
+            for i, p1 in enumerate(contour):
+                p2 = contour[(i + 1) % len(contour)]
+                # Stickies can't be placed on flat ground.
+                if not (
+                    p2[1] == p1[1]
+                    and (p2[0] > p1[0] if contour_idx == 0 else p2[0] < p1[0])
+                ):
+                    self._sticky_segment_grid.add(
+                        _encode_segment_coords(p1, p2), (contour_idx, i), p1, p2
+                    )
 
         for sand_pit in sand_pits:
             for i, p1 in enumerate(sand_pit):
@@ -227,17 +497,31 @@ class Physics:
                 shape.elasticity = self._sand_elasticity
                 shape.collision_type = _sand_collision_type
                 self._space.add(shape)
+                preview_shape = self._shot_preview.add_segment(shape)
                 seg_key = _encode_segment_coords(p1, p2)
-                if seg_key in self._contour_segment_map:
-                    self._contour_segment_map[seg_key] = _ContourSegment(
-                        shape, _ContourSegmentType.SAND
+                if seg_key in simplified_segments:
+                    run = simplified_segments[seg_key].run
+                    sand_segment = _ContourSegment(
+                        shape, preview_shape, _ContourSegmentType.SAND, run
                     )
+                    for c1, c2 in zip(run, run[1:]):
+                        k = _encode_segment_coords(c1, c2)
+                        self._contour_segment_map[k] = sand_segment
+                        self._sticky_segment_grid.remove(k)
+
+        _use_broadphase(self._space, broadphase)
+        _use_broadphase(self._shot_preview.space, broadphase)
 
         self._is_in_shot = False
+        # The ball starts at rest on the start flat, and between shots it stays
+        # where it stopped, so the space isn't stepped until the next shot.
+        self._is_ball_resting = True
         self.ball_radius = ball_radius
         shape = self._make_ball_shape(ball_position)
         self._space.add(shape.body, shape)
         self._ball_shape = shape
+        self._snapshot = self._take_snapshot()
+        self._previous_snapshot = self._snapshot
 
         self._flag_collision_shape = pymunk.Poly(
             self._space.static_body,
@@ -276,9 +560,41 @@ class Physics:
 
         self._bind_events()
 
+    # Adds the shapes of a segment of the simplified contours, which is used for
+    # every segment of its run until a sticky is placed on part of it. Interior
+    # contours wind the other way, so their segments are reversed.
+    def _add_contour_segment(self, p1, p2, run, is_exterior):
+        if is_exterior:
+            shape = pymunk.Segment(self._space.static_body, p1, p2, 0.1)
+        else:
+            shape = pymunk.Segment(self._space.static_body, p2, p1, 0.1)
+        shape.friction = self._friction
+        shape.elasticity = self._elasticity
+        self._space.add(shape)
+        segment = _ContourSegment(
+            shape,
+            self._shot_preview.add_segment(shape),
+            _ContourSegmentType.NORMAL,
+            run,
+        )
+        for c1, c2 in zip(run, run[1:]):
+            self._contour_segment_map[_encode_segment_coords(c1, c2)] = segment
+        return segment
+
+    # Replaces the shapes of a simplified segment with one for each segment of
+    # its run, so that a sticky can cover only some of them.
+    def _split_contour_segment(self, segment):
+        self._space.remove(segment.pymunk_shape)
+        self._shot_preview.remove_segment(segment.preview_pymunk_shape)
+        is_exterior = segment.pymunk_shape.a == segment.run[0]
+        for c1, c2 in zip(segment.run, segment.run[1:]):
+            self._add_contour_segment(c1, c2, [c1, c2], is_exterior)
+
     def _on_ball_flag_collision(self, _arb, _space, _data):
         if self._hole_animation_start_time is not None:
             return False
+        if self._recorder is not None:
+            self._recorder.record_reach_flag(self.update_num, self.ball_position)
         self._on_reach_flag()
         return False
 
@@ -309,6 +625,29 @@ class Physics:
         return shape
 
     def update(self, dt):
+        result = self._update(dt)
+        self._previous_snapshot = self._snapshot
+        # A resting ball doesn't move, so its snapshot is kept.
+        if not (self._is_ball_resting and self._snapshot.is_resting):
+            self._snapshot = self._take_snapshot()
+        return result
+
+    def _take_snapshot(self):
+        return PhysicsSnapshot(
+            ball_position=self._ball_shape.body.position,
+            ball_velocity=self._ball_shape.body.velocity,
+            ball_trail_points=self._ball_trail_points,
+            is_resting=self._is_ball_resting,
+        )
+
+    # The ball as it is drawn alpha of the way from the previous update to the
+    # last one.
+    def get_snapshot(self, alpha):
+        return self._snapshot.interpolate(self._previous_snapshot, alpha)
+
+    def _update(self, dt):
+        self.update_num += 1
+        self._input_source.poll()
         assert not (self._is_in_shot and self._mouse_dragging)
         if self._hole_animation_start_time is not None:
             if self._hole_animation_start_time is False:
@@ -347,14 +686,27 @@ class Physics:
             self._mouse_dragging
             and self._mouse_dragging.state == _MouseDraggingState.RELEASED
         ):
+            self.shoot(self.get_drag_velocity())
+            self._mouse_dragging = None
+        if self._shot_velocity is not None:
             self.shot_number += 1
             self._is_in_shot = True
+            self._is_ball_resting = False
             self._space.gravity = self._gravity
-            self._ball_shape.body.velocity = self.get_drag_velocity()
-            self._mouse_dragging = None
+            self._ball_shape.body.velocity = self._shot_velocity
+            self._shot_velocity = None
             self._ball_flag_collision_handler.begin = self._on_ball_flag_collision
+            if self._recorder is not None:
+                self._recorder.record_shot(self.update_num, self.ball_velocity)
             self._on_shot_start()
-        self._space.step(dt)
+        if self._is_ball_resting:
+            return
+        num_substeps = _get_num_substeps(
+            self._ball_shape.body.velocity, dt, self._max_ball_step_distance
+        )
+        with span("pymunk.step", substeps=num_substeps):
+            for _ in range(num_substeps):
+                self._space.step(dt / num_substeps)
         if (
             self._is_in_shot
             and self._ball_shape.body.velocity.get_length_sqrd() < 0.000000001
@@ -364,9 +716,12 @@ class Physics:
             self._space.add(shape.body, shape)
             self._ball_shape = shape
             self._is_in_shot = False
+            self._is_ball_resting = True
             self._ball_flag_collision_handler.begin = lambda _arb, _space, _data: False
             self._updates_until_new_ball_trail_point = 0
             self._ball_trail_points = []
+            if self._recorder is not None:
+                self._recorder.record_shot_end(self.update_num, self.ball_position)
             self._on_shot_end()
             return False
         if self._is_in_shot:
@@ -377,9 +732,11 @@ class Physics:
             self._updates_until_new_ball_trail_point = (
                 self._updates_per_new_ball_trail_point
             )
-            self._ball_trail_points.append(self._get_ball_trail_point())
-            if len(self._ball_trail_points) > self._num_ball_trail_points:
-                self._ball_trail_points.pop(0)
+            # Replaced rather than changed, as snapshots keep the old list.
+            point = self._get_ball_trail_point(self.ball_position, self.ball_velocity)
+            self._ball_trail_points = (self._ball_trail_points + [point])[
+                -self._num_ball_trail_points :
+            ]
         self._updates_until_new_ball_trail_point -= 1
 
     def animate_ball_into_hole(self):
@@ -387,13 +744,19 @@ class Physics:
         self._hole_animation_start_time = time()
         self._hole_animation_start_pos = self.ball_position
 
+    # Takes a shot with the velocity on the next update, as releasing a drag
+    # does.
+    def shoot(self, velocity):
+        assert not self._is_in_shot
+        self._shot_velocity = velocity
+
     def get_drag_velocity(self):
         vel = (self._mouse_dragging.start - self._mouse_dragging.current).scale(
             self._shot_sensitivity
         )
         if vel.dot(vel) > self._max_power**2:
-            return vel.normalize().scale(self._max_power)
-        return vel
+            vel = vel.normalize().scale(self._max_power)
+        return self._shot_preview.quantise_velocity(vel)
 
     def get_drag_start(self):
         return self._mouse_dragging.start
@@ -406,31 +769,51 @@ class Physics:
         return self._mouse_dragging.current
 
     def simulate_ball_path_from_position_with_velocity(self, position, velocity):
-        space = pymunk.Space()
-        space.gravity = self._gravity
-        ball_shape = self._ball_shape.copy()
-        ball_shape.body.position = position
-        ball_shape.body.velocity = velocity
-        space.add(ball_shape.body, ball_shape)
-        dt = 1 / self._game.updates_per_second
-        positions = [Vec2(ball_shape.body.position[0], ball_shape.body.position[1])]
-        for _ in range(self._shot_preview_simulation_updates):
-            space.step(dt)
-            pos = Vec2(ball_shape.body.position[0], ball_shape.body.position[1])
-            positions.append(pos)
-        return positions
+        return self._shot_preview.simulate_ball_path(
+            self._ball_shape, position, velocity
+        )
 
-    def _get_ball_trail_point(self):
-        pos = self.ball_position
+    # A simulator for many balls at once with the walls, sand and stickies as
+    # they are now.
+    def make_batch_simulator(self):
+        segment_kinds = {
+            _sand_collision_type: SEGMENT_SAND,
+            _sticky_collision_type: SEGMENT_STICKY,
+        }
+        segments = [
+            BatchSegment(
+                a=(shape.a[0], shape.a[1]),
+                b=(shape.b[0], shape.b[1]),
+                radius=shape.radius,
+                friction=shape.friction,
+                elasticity=shape.elasticity,
+                kind=segment_kinds.get(shape.collision_type, SEGMENT_NORMAL),
+            )
+            for shape in self._space.shapes
+            if isinstance(shape, pymunk.Segment)
+        ]
+        return BatchSimulator(
+            segments=segments,
+            ball_radius=self.ball_radius,
+            ball_friction=self._ball_shape.friction,
+            ball_elasticity=self._ball_shape.elasticity,
+            gravity=self._gravity,
+            dt=1 / self._updates_per_second,
+            max_ball_step_distance=self._max_ball_step_distance,
+            flag_position=self._flag_position,
+            flag_width=self._flag_collision_shape_radius,
+        )
+
+    def _get_ball_trail_point(self, pos, velocity):
         ccw_offset = (
-            Vec2(-self._ball_shape.body.velocity[1], self._ball_shape.body.velocity[0])
-            .normalize()
-            .scale(self._ball_trail_width)
+            Vec2(-velocity[1], velocity[0]).normalize().scale(self._ball_trail_width)
         )
         return (pos + ccw_offset, pos - ccw_offset)
 
-    def get_ball_trail(self):
-        return self._ball_trail_points + [self._get_ball_trail_point()]
+    def get_ball_trail(self, snapshot):
+        return snapshot.ball_trail_points + [
+            self._get_ball_trail_point(snapshot.ball_position, snapshot.ball_velocity)
+        ]
 
     def get_preview_sticky(self):
         if self._mode.state != _ModeState.PLACE_STICKY or not isinstance(
@@ -445,53 +828,80 @@ class Physics:
             is_preview=True,
         )
 
+    # Places a sticky on the walls in the sticky radius around the world
+    # position, returning whether there were any.
+    @traced
+    def place_sticky(self, position):
+        sticky = self._get_closest_sticky_in_radius_of_position(
+            position=position, radius=self._sticky_radius, is_preview=False
+        )
+        if not sticky:
+            return False
+        for c1, c2 in zip(sticky.wall, sticky.wall[1:]):
+            k = _encode_segment_coords(c1, c2)
+            if len(self._contour_segment_map[k].run) > 2:
+                self._split_contour_segment(self._contour_segment_map[k])
+            segment = self._contour_segment_map[k]
+            segment.pymunk_shape.collision_type = _sticky_collision_type
+            segment.preview_pymunk_shape.collision_type = _sticky_collision_type
+            self._contour_segment_map[k] = _ContourSegment(
+                segment.pymunk_shape,
+                segment.preview_pymunk_shape,
+                _ContourSegmentType.STICKY,
+                segment.run,
+            )
+            self._sticky_segment_grid.remove(k)
+        self._shot_preview.clear_cache()
+        (
+            new_stickies,
+            new_sticky,
+            removed_stickies,
+        ) = add_sticky_to_stickies(self._stickies, sticky)
+        self._stickies = new_stickies
+        for removed_sticky in removed_stickies:
+            self._on_sticky_removed(removed_sticky)
+        self._on_new_sticky(new_sticky)
+        if self._recorder is not None:
+            self._recorder.record_sticky(self.update_num, position)
+        return True
+
     def _get_closest_sticky_in_radius_of_position(self, position, radius, is_preview):
+        contours = [self._exterior_contour] + self._contours
         stickies = []
-        for i, contour in enumerate([self._exterior_contour] + self._contours):
-            is_exterior = i == 0
-            cur_wall = []
-            prev_collides = False
-            for j, c1 in enumerate(contour):
-                c2 = contour[(j + 1) % len(contour)]
-                # Check segment type is normal.
-                is_good = (
-                    self._contour_segment_map[_encode_segment_coords(c1, c2)].seg_type
-                    == _ContourSegmentType.NORMAL
-                )
-                # Check is not flat ground.
-                is_good = is_good and not (
-                    c2[1] == c1[1] and (c2[0] > c1[0] if i == 0 else c2[0] < c1[0])
-                )
-                # Check collides with circle.
-                is_good = is_good and do_circle_and_line_segment_intersect(
-                    position, radius, c1, c2
-                )
-                if is_good:
-                    if not prev_collides:
-                        cur_wall.append(c1)
-                    cur_wall.append(c2)
-                    prev_collides = True
-                else:
-                    if prev_collides:
-                        stickies.append(
-                            Sticky(
-                                wall=cur_wall,
-                                contour=contour,
-                                is_exterior=is_exterior,
-                                is_preview=is_preview,
-                            )
-                        )
-                        cur_wall = []
-                    prev_collides = False
-            if len(cur_wall) > 0:
-                stickies.append(
-                    Sticky(
-                        wall=cur_wall,
-                        contour=contour,
-                        is_exterior=is_exterior,
-                        is_preview=is_preview,
-                    )
+        cur_wall = []
+        prev_segment = None
+
+        def add_cur_wall():
+            contour_idx = prev_segment[0]
+            stickies.append(
+                Sticky(
+                    wall=cur_wall,
+                    contour=contours[contour_idx],
+                    is_exterior=contour_idx == 0,
+                    is_preview=is_preview,
                 )
+            )
+
+        # The endpoint test in do_circle_and_line_segment_intersect compares the
+        # squared distance to the radius, so it can reach sqrt(radius) away.
+        for segment in self._sticky_segment_grid.query(
+            position, max(radius, math.sqrt(radius))
+        ):
+            contour_idx, j = segment
+            contour = contours[contour_idx]
+            c1 = contour[j]
+            c2 = contour[(j + 1) % len(contour)]
+            if not do_circle_and_line_segment_intersect(position, radius, c1, c2):
+                continue
+            # Walls are runs of neighbouring segments in a contour.
+            if prev_segment != (contour_idx, j - 1):
+                if cur_wall:
+                    add_cur_wall()
+                cur_wall = [c1]
+            cur_wall.append(c2)
+            prev_segment = segment
+        if cur_wall:
+            add_cur_wall()
         if len(stickies) == 0:
             return None
 
@@ -526,6 +936,14 @@ class Physics:
         velocity = self._ball_shape.body.velocity
         return Vec2(velocity[0], velocity[1])
 
+    @property
+    def is_in_shot(self):
+        return self._is_in_shot
+
+    @property
+    def is_ball_resting(self):
+        return self._is_ball_resting
+
     @property
     def is_dragging(self):
         return (
@@ -584,30 +1002,11 @@ class Physics:
                 if self._mode.mouse_pos is False:
                     self._mode = _PlaceStickyMode(self._mouse_position)
                 elif isinstance(self._mode.mouse_pos, Vec2):
-                    sticky = self._get_closest_sticky_in_radius_of_position(
-                        position=self._camera.screen_position_to_world_position(
+                    if self.place_sticky(
+                        self._camera.screen_position_to_world_position(
                             self._mode.mouse_pos
-                        ),
-                        radius=self._sticky_radius,
-                        is_preview=False,
-                    )
-                    if sticky:
-                        for c1, c2 in zip(sticky.wall, sticky.wall[1:]):
-                            k = _encode_segment_coords(c1, c2)
-                            shape = self._contour_segment_map[k].pymunk_shape
-                            shape.collision_type = _sticky_collision_type
-                            self._contour_segment_map[k] = _ContourSegment(
-                                shape, _ContourSegmentType.STICKY
-                            )
-                        (
-                            new_stickies,
-                            new_sticky,
-                            removed_stickies,
-                        ) = add_sticky_to_stickies(self._stickies, sticky)
-                        self._stickies = new_stickies
-                        for removed_sticky in removed_stickies:
-                            self._on_sticky_removed(removed_sticky)
-                        self._on_new_sticky(new_sticky)
+                        )
+                    ):
                         self._mode = _MakeShotMode()
             if self._is_in_shot or self._mode.state != _ModeState.MAKE_SHOT:
                 return
@@ -660,16 +1059,16 @@ class Physics:
             ):
                 self._mode = _PlaceStickyMode(Vec2(x, y))
 
-        self._game.window.push_handlers(
-            on_mouse_press,
-            on_mouse_drag,
-            on_mouse_release,
-            on_key_release,
-            on_mouse_motion,
+        self._input_source.bind(
+            on_mouse_press=on_mouse_press,
+            on_mouse_drag=on_mouse_drag,
+            on_mouse_release=on_mouse_release,
+            on_key_release=on_key_release,
+            on_mouse_motion=on_mouse_motion,
         )
 
     def _unbind_events(self):
         if self._did_unbind_events:
             return
         self._did_unbind_events = True
-        self._game.window.pop_handlers()
+        self._input_source.unbind()
@@ -1,6 +1,4 @@
 import math
-from random import choice
-from threading import Thread
 from enum import Enum, auto
 from time import time
 from pyglet import gl
@@ -9,18 +7,19 @@ import pyshaders
 from Camera import Camera
 from GameScreen import GameScreen
 import MainMenuScreen
-from cave_gen import (
-    make_cave_grid,
-    make_cave_contours,
-    place_start_flat_and_flag_flat,
-    make_sand_pits,
-)
 from Geometry import (
     Geometry,
     ColoredPlatformBuffer,
     ColoredPlatformBufferWithGradientTexture,
 )
 from Physics import Physics
+from InputSource import WindowInputSource
+from ShotLog import ShotRecorder
+from config import config
+from CaveGenerator import cave_generator
+from tracing import span, traced
+from HoleSolver import hole_solver
+from GpuProfiler import gpu_profiler
 from assets import assets
 from widgets import (
     Label,
@@ -108,41 +107,6 @@ class GameState:
         self.hole_shots = [] if hole_shots is None else hole_shots
 
 
-def _gen_cave(width, height, pseudo_3d_ground_height, ball_radius):
-    cave_grid = make_cave_grid(
-        width=width,
-        height=height,
-        wall_chance=40,
-        min_surrounding_walls=5,
-        iterations=5,
-        pillar_iterations=5,
-        min_open_percent=0.3,
-    )
-    cave_contours = make_cave_contours(cave_grid, width, height)
-    start_flat, flag_flat = place_start_flat_and_flag_flat(cave_contours, cave_grid)
-    sand_pits = make_sand_pits(
-        contours=cave_contours,
-        min_sand_pit_area=2,
-        max_sand_pit_area=36,
-        max_sand_pits=choice((2, 3, 3, 3, 3, 4, 5)),
-        avoid_rects=[
-            start_flat.make_rect(pseudo_3d_ground_height),
-            flag_flat.make_rect(pseudo_3d_ground_height),
-        ],
-        ball_radius=ball_radius,
-    )
-    return cave_contours, start_flat, flag_flat, sand_pits
-
-
-class CallbackThread(Thread):
-    def __init__(self, cb, target, args):
-        Thread.__init__(self, None, target, None, args)
-        self._cb = cb
-
-    def run(self):
-        self._cb(self._target(*self._args))
-
-
 def clamp(x, a, b):
     if x < a:
         return a
@@ -191,11 +155,17 @@ class PlayScreen(GameScreen):
         self._geometry = None
         self._camera = None
         self._physics = None
+        self._shot_recorder = None
         self._reached_flag = False
         self._level_complete = False
         self._game_state = game_state
         self._cave = cave
         self._next_cave = None
+        self._next_cave_request = None
+        self._cave_args = None
+        self._physics_settings = None
+        self._par = None
+        self._solution_request = None
         self._did_delay = False
         self._shot_label = None
         self._game_done_time = None
@@ -226,6 +196,7 @@ class PlayScreen(GameScreen):
 
         def on_menu_btn_click(_widget):
             self._game.set_screen(MainMenuScreen.MainMenuScreen())
+            cave_generator().cancel()
 
         def make_labels_hbox():
             labels_hbox = TopRightHBox()
@@ -302,7 +273,9 @@ class PlayScreen(GameScreen):
         self._game.on_size_change(self._refresh_gui)
 
     def _get_shot_label_text(self):
-        return f"Shot {self._physics.shot_number+1}"
+        if self._par is None:
+            return f"Shot {self._physics.shot_number+1}"
+        return f"Shot {self._physics.shot_number+1} (par {self._par})"
 
     def _remove_gui(self):
         for widget in self._gui_elements:
@@ -314,6 +287,7 @@ class PlayScreen(GameScreen):
         self._remove_gui()
         self._add_gui()
 
+    @traced
     def bind(self, game):
         self._game = game
 
@@ -327,16 +301,18 @@ class PlayScreen(GameScreen):
             width, height = 35, 25
         else:
             width, height = 60, 30
-        cave_contours, start_flat, flag_flat, sand_pits = self._cave or _gen_cave(
-            width, height, pseudo_3d_ground_height, ball_radius
+        cave_args = (width, height, pseudo_3d_ground_height, ball_radius)
+        cave = self._cave or cave_generator().get_cave(
+            self._game_state.mode, cave_args
         )
+        cave_contours = cave.contours
+        start_flat = cave.start_flat
+        flag_flat = cave.flag_flat
+        sand_pits = cave.sand_pits
         if not is_on_last_hole(self._game_state):
-            thread = CallbackThread(
-                cb=self._on_thread_done,
-                target=_gen_cave,
-                args=(width, height, pseudo_3d_ground_height, ball_radius),
+            self._next_cave_request = cave_generator().request_cave(
+                self._game_state.mode, cave_args, self._on_next_cave_generated
             )
-            thread.start()
 
         fb_width = self._game.window.width
         fb_height = self._game.window.height
@@ -445,28 +421,49 @@ class PlayScreen(GameScreen):
                 for p in points
             ]
 
+        # Everything besides the cave that decides where the ball goes, which
+        # shot logs keep so that holes can be replayed.
+        physics_settings = {
+            "ball_radius": ball_radius,
+            "max_power": 75,
+            "shot_sensitivity": 0.4,
+            "gravity": Vec2(0, -30),
+            "flag_collision_shape_radius": flag_hole_width,
+            "max_ball_step_distance": 0.35,
+            "sticky_radius": 6,
+            "broadphase": config().physics_broadphase,
+        }
+        if config().shot_log_dir is not None:
+            self._shot_recorder = ShotRecorder(
+                seed=cave.seed,
+                cave_args=cave_args,
+                updates_per_second=self._game.updates_per_second,
+                point_shift=self._geometry.raw_point_shift,
+                physics_settings=physics_settings,
+            )
+
         self._camera = Camera(self._game.window.width, self._game.window.height)
         self._physics = Physics(
-            game=self._game,
+            updates_per_second=self._game.updates_per_second,
+            input_source=WindowInputSource(self._game.window),
             camera=self._camera,
             contours=[shift_points(contour) for contour in cave_contours[1:]],
             exterior_contour=shift_points(cave_contours[0]),
+            contour_runs=[
+                [shift_points(run) for run in runs] for runs in cave.contour_runs[1:]
+            ],
+            exterior_contour_runs=[shift_points(run) for run in cave.contour_runs[0]],
             sand_pits=[shift_points(sand_pit) for sand_pit in sand_pits],
             ball_position=start_flat.get_middle()
             + self._geometry.raw_point_shift
             + Vec2(0, ball_radius),
-            ball_radius=ball_radius,
-            max_power=75,
-            shot_sensitivity=0.4,
-            gravity=Vec2(0, -30),
             flag_position=flag_flat.get_middle() + self._geometry.raw_point_shift,
-            flag_collision_shape_radius=flag_hole_width,
             shot_preview_simulation_updates=shot_preview_simulation_updates,
+            shot_preview_velocity_quantum=0.1,
             updates_per_new_ball_trail_point=self._game.updates_per_second
             // ball_trail_points_per_second,
             num_ball_trail_points=num_ball_trail_points,
             ball_trail_width=ball_radius / 2,
-            sticky_radius=6,
             on_new_sticky=self._geometry.add_sticky,
             on_sticky_removed=self._geometry.remove_sticky,
             on_reach_flag=self._on_reach_flag,
@@ -478,10 +475,23 @@ class PlayScreen(GameScreen):
             get_is_paused=lambda: self._paused,
             on_ball_sticky_collision=self._on_ball_sticky_collision,
             on_ball_sand_collision=self._on_ball_sand_collision,
+            recorder=self._shot_recorder,
+            **physics_settings,
         )
+        self._cave_args = cave_args
+        self._physics_settings = physics_settings
 
         self._add_gui()
+        if config().show_par:
+            self._solution_request = hole_solver().request_solution(
+                cave,
+                cave_args,
+                self._game.updates_per_second,
+                physics_settings,
+                self._on_solution,
+            )
 
+    @traced
     def render(self):
         self._camera.set_window_dimensions(
             self._game.window.width, self._game.window.height
@@ -494,6 +504,12 @@ class PlayScreen(GameScreen):
             (self._geometry.exterior_rect.width - self._camera.width) / 2,
             (self._geometry.exterior_rect.height - self._camera.get_height()) / 2,
         )
+        # While paused nothing is updated, so the last update is drawn as it is.
+        alpha = (
+            1
+            if self._paused or self._level_complete
+            else self._game.interpolation_alpha
+        )
         fade_anim_duration = 0.15
         if (
             not self._paused
@@ -512,6 +528,7 @@ class PlayScreen(GameScreen):
                 camera=self._camera,
                 physics=self._physics,
                 framebuffer=self._fboA,
+                alpha=alpha,
             )
             iterations = 10
             read_fb = self._fboA
@@ -530,26 +547,29 @@ class PlayScreen(GameScreen):
             else:
                 t = min((time() - self._game_done_time) / fade_anim_duration, 1)
             T = 1 - (1 - t) ** 2
-            for i in range(iterations):
-                radius = (iterations - i) * T / 2
-                gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, write_fb.fbo)
-                gl.glBindTexture(gl.GL_TEXTURE_2D, read_fb.tex)
-                blurred_background_shader.uniforms.u_direction = (
-                    (radius, 0) if i % 2 == 0 else (0, radius)
-                )
-                # pylint: enable=assigning-non-slot
-                gl.glClearColor(0, 0, 0, 0)
-                gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-                self._background_vertex_buffer.bind_to_attrib(
-                    blurred_background_shader.attributes.a_vertex_position
-                )
-                self._background_tex_coords_buffer.bind_to_attrib(
-                    blurred_background_shader.attributes.a_texture_coord
-                )
-                gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
-                read_fb, write_fb = write_fb, read_fb
-            blurred_background_shader.clear()
+            gpu_profiler().begin_pass("blur")
+            with span("blur", iterations=iterations):
+                for i in range(iterations):
+                    radius = (iterations - i) * T / 2
+                    gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, write_fb.fbo)
+                    gl.glBindTexture(gl.GL_TEXTURE_2D, read_fb.tex)
+                    blurred_background_shader.uniforms.u_direction = (
+                        (radius, 0) if i % 2 == 0 else (0, radius)
+                    )
+                    # pylint: enable=assigning-non-slot
+                    gl.glClearColor(0, 0, 0, 0)
+                    gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+                    self._background_vertex_buffer.bind_to_attrib(
+                        blurred_background_shader.attributes.a_vertex_position
+                    )
+                    self._background_tex_coords_buffer.bind_to_attrib(
+                        blurred_background_shader.attributes.a_texture_coord
+                    )
+                    gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
+                    read_fb, write_fb = write_fb, read_fb
+                blurred_background_shader.clear()
             gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+            gpu_profiler().begin_pass("composite")
             clear_gl((0, 0, 0))
             gl.glBindTexture(gl.GL_TEXTURE_2D, write_fb.tex)
             whiten_texture_shader.use()
@@ -564,9 +584,13 @@ class PlayScreen(GameScreen):
             gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
             gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
             whiten_texture_shader.clear()
+            gpu_profiler().end_pass()
         else:
             self._geometry.render(
-                camera=self._camera, physics=self._physics, framebuffer=None
+                camera=self._camera,
+                physics=self._physics,
+                framebuffer=None,
+                alpha=alpha,
             )
         if self._level_complete and is_on_last_hole(self._game_state):
             pass
@@ -593,13 +617,29 @@ class PlayScreen(GameScreen):
             hole_shots=self._game_state.hole_shots + [self._physics.shot_number],
         )
 
-    def _on_thread_done(self, cave):
+    def _on_next_cave_generated(self, cave):
+        self._next_cave_request = None
         self._next_cave = cave
+        # Solved while this hole is played so that its par is ready straight
+        # away.
+        if config().show_par:
+            hole_solver().prefetch(
+                cave,
+                self._cave_args,
+                self._game.updates_per_second,
+                self._physics_settings,
+            )
         if self._level_complete:
             self._game.set_screen(
                 PlayScreen(game_state=self._get_next_game_state(), cave=self._next_cave)
             )
 
+    def _on_solution(self, solution):
+        self._solution_request = None
+        self._par = solution.par
+        if self._shot_label is not None:
+            self._shot_label.set_text(self._get_shot_label_text())
+
     def _on_reach_flag(self):
         self._reached_flag = True
         if self._game.is_sound_enabled:
@@ -632,9 +672,18 @@ class PlayScreen(GameScreen):
     def unbind(self):
         self._remove_gui()
         self._game = None
+        if self._next_cave_request:
+            cave_generator().cancel_request(self._next_cave_request)
+            self._next_cave_request = None
+        if self._solution_request:
+            hole_solver().cancel_request(self._solution_request)
+            self._solution_request = None
         if self._physics:
             self._physics.dispose()
             self._physics = None
+        if self._shot_recorder and self._shot_recorder.log["events"]:
+            self._shot_recorder.save(config().shot_log_dir)
+            self._shot_recorder = None
         self._geometry.dispose()
         self._geometry = None
         self._camera = None
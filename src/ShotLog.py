@@ -0,0 +1,66 @@
+import json
+import os
+from time import time
+
+
+_format_version = 1
+
+
+# Records what is needed to replay a hole through Physics: the cave, the
+# physics settings, and every shot and sticky with the update it happened in.
+# Shot ends and reaching the flag are recorded too, so that a replay can check
+# the ball ends up in exactly the same places. Events are stored as
+# [kind, update number, x, y], where x and y are the launch velocity for shots
+# and the ball or sticky position otherwise.
+class ShotRecorder:
+    def __init__(
+        self, seed, cave_args, updates_per_second, point_shift, physics_settings
+    ):
+        self.log = {
+            "format_version": _format_version,
+            "seed": seed,
+            "cave_args": list(cave_args),
+            "updates_per_second": updates_per_second,
+            "point_shift": [point_shift[0], point_shift[1]],
+            "physics_settings": {
+                name: list(value) if isinstance(value, tuple) else value
+                for name, value in physics_settings.items()
+            },
+            "events": [],
+        }
+
+    def _record(self, kind, update_num, point):
+        self.log["events"].append([kind, update_num, point[0], point[1]])
+
+    def record_shot(self, update_num, velocity):
+        self._record("shot", update_num, velocity)
+
+    def record_shot_end(self, update_num, ball_position):
+        self._record("shot_end", update_num, ball_position)
+
+    def record_reach_flag(self, update_num, ball_position):
+        self._record("reach_flag", update_num, ball_position)
+
+    def record_sticky(self, update_num, position):
+        self._record("sticky", update_num, position)
+
+    def save(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(
+            log_dir, f"{int(time() * 1000)}-{self.log['seed']:016x}.json"
+        )
+        # Written to a temporary file first so that a replay never reads a
+        # partially written log.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.log, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+        return path
+
+
+def load_shot_log(path):
+    with open(path, encoding="utf-8") as f:
+        log = json.load(f)
+    if log.get("format_version") != _format_version:
+        raise ValueError(f"{path} is not a shot log in the current format")
+    return log
@@ -1,14 +1,37 @@
-from assets import assets
-from config import config
-from Game import Game
-from MainMenuScreen import MainMenuScreen
-
-
 if __name__ == "__main__":
+    # Imported here because the cave generation worker processes run this module
+    # too (under a different name), and they mustn't load the game or open GL.
+    # pylint: disable=import-outside-toplevel
+    from assets import assets
+    from config import config
+    from Game import Game
+    from MainMenuScreen import MainMenuScreen
+    from CaveGenerator import cave_generator
+    from HoleSolver import hole_solver
+    from GpuProfiler import gpu_profiler
+    import tracing
+
     assets()
     game = Game(
         screen=MainMenuScreen(),
         updates_per_second=config().updates_per_second,
         target_fps=config().target_fps,
+        max_updates_per_tick=config().max_updates_per_tick,
+        frame_stats_capacity=config().frame_stats_capacity,
+        frame_stats_overlay_keys=config().frame_stats_overlay_keys,
+        is_frame_stats_overlay_shown=config().show_frame_stats_overlay,
+        trace_keys=config().trace_keys,
+        trace_dir=config().trace_dir,
+        gpu_profiler_keys=config().gpu_profiler_keys,
     )
+    if config().is_tracing_on_start:
+        game.toggle_tracing()
+    if config().is_gpu_profiling_on_start:
+        gpu_profiler().set_is_enabled(True)
     game.run()
+    if tracing.is_enabled():
+        game.toggle_tracing()
+    if config().frame_stats_path is not None:
+        game.frame_stats.save(config().frame_stats_path)
+    cave_generator().shutdown()
+    hole_solver().shutdown()
@@ -0,0 +1,208 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter, time
+import numpy as np
+from cave_gen import gen_cave
+
+# Runs the cave generation pipeline over fixed seeds and reports how long each
+# stage takes and how much memory it uses. Needs no window or GL context.
+#
+#   python bench_cave_gen.py --output results.json
+#   python bench_cave_gen.py --compare results.json
+
+SIZES = {
+    "easy": (35, 25),
+    "hard": (60, 30),
+    "large": (120, 60),
+    "huge": (240, 120),
+}
+STAGES = [
+    "make_cave_grid",
+    "make_cave_contours",
+    "place_start_flat_and_flag_flat",
+    "make_sand_pits",
+    "simplify_contours",
+]
+PSEUDO_3D_GROUND_HEIGHT = 0.6
+BALL_RADIUS = 0.6
+
+
+def _time_stages(width, height, seed, stats=None):
+    times = {}
+
+    @contextmanager
+    def measure_stage(name):
+        start = perf_counter()
+        yield
+        times[name] = perf_counter() - start
+
+    gen_cave(
+        width,
+        height,
+        PSEUDO_3D_GROUND_HEIGHT,
+        BALL_RADIUS,
+        seed,
+        measure_stage,
+        stats=stats,
+    )
+    return times
+
+
+# Memory is measured on a separate run because tracing every allocation slows
+# the stages down too much for their times to mean anything.
+def _measure_stage_memory(width, height, seed):
+    memory = {}
+
+    @contextmanager
+    def measure_stage(name):
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        start_blocks = sys.getallocatedblocks()
+        yield
+        end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        memory[name] = {
+            "peak_bytes": peak_bytes - start_bytes,
+            "retained_bytes": end_bytes - start_bytes,
+            "retained_blocks": sys.getallocatedblocks() - start_blocks,
+        }
+
+    tracemalloc.start()
+    try:
+        gen_cave(
+            width, height, PSEUDO_3D_GROUND_HEIGHT, BALL_RADIUS, seed, measure_stage
+        )
+    finally:
+        tracemalloc.stop()
+    return memory
+
+
+def _summarize(values):
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "mean": statistics.fmean(values),
+        "max": max(values),
+    }
+
+
+def run(sizes, seeds, repeats):
+    results = {}
+    for size_name in sizes:
+        width, height = SIZES[size_name]
+        stage_times = {stage: [] for stage in STAGES}
+        stage_memory = {stage: [] for stage in STAGES}
+        num_grid_candidates = []
+        # Warm up first so that lazy imports and first-call costs aren't timed.
+        _time_stages(width, height, seeds[0])
+        for seed in seeds:
+            stats = {}
+            for _ in range(repeats):
+                for stage, t in _time_stages(width, height, seed, stats).items():
+                    stage_times[stage].append(t)
+            num_grid_candidates.append(stats["num_grid_candidates"])
+            for stage, m in _measure_stage_memory(width, height, seed).items():
+                stage_memory[stage].append(m)
+        results[size_name] = {
+            "width": width,
+            "height": height,
+            "num_grid_candidates": _summarize(num_grid_candidates),
+            "stages": {
+                stage: {
+                    "seconds": _summarize(stage_times[stage]),
+                    "peak_bytes": _summarize(
+                        [m["peak_bytes"] for m in stage_memory[stage]]
+                    ),
+                    "retained_bytes": _summarize(
+                        [m["retained_bytes"] for m in stage_memory[stage]]
+                    ),
+                    "retained_blocks": _summarize(
+                        [m["retained_blocks"] for m in stage_memory[stage]]
+                    ),
+                }
+                for stage in STAGES
+            },
+        }
+    return results
+
+
+def _get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'size':<8}{'stage':<34}{'median ms':>10}{'max ms':>10}"
+        f"{'peak KiB':>10}{'vs base':>9}"
+    )
+    for size_name, size_results in results.items():
+        for stage, stage_results in size_results["stages"].items():
+            median = stage_results["seconds"]["median"]
+            line = (
+                f"{size_name:<8}{stage:<34}{median * 1000:>10.2f}"
+                f"{stage_results['seconds']['max'] * 1000:>10.2f}"
+                f"{stage_results['peak_bytes']['max'] / 1024:>10.1f}"
+            )
+            try:
+                base_median = baseline[size_name]["stages"][stage]["seconds"]["median"]
+                line += f"{median / base_median:>8.2f}x"
+            except (KeyError, TypeError, ZeroDivisionError):
+                pass
+            print(line)
+    for size_name, size_results in results.items():
+        candidates = size_results["num_grid_candidates"]
+        print(
+            f"{size_name:<8}grid candidates tried: mean {candidates['mean']:.2f}, "
+            f"max {candidates['max']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of cave generation."
+    )
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--seeds", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file of results to compare to")
+    args = parser.parse_args()
+
+    results = run(args.sizes, range(args.seeds), args.repeats)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "revision": _get_revision(),
+                    "time": time(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "seeds": args.seeds,
+                    "repeats": args.repeats,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
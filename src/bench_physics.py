@@ -0,0 +1,241 @@
+import argparse
+from collections import defaultdict
+import json
+import math
+import platform
+from random import Random
+import statistics
+from time import perf_counter, time
+import pyglet
+
+# Nothing is drawn, so pyglet mustn't open the hidden window it shares GL
+# contexts with, which also means no display is needed.
+pyglet.options["shadow_window"] = False
+
+# pylint: disable=wrong-import-position
+from pyglet.math import Vec2
+import pymunk
+from bench_cave_gen import SIZES, PSEUDO_3D_GROUND_HEIGHT, BALL_RADIUS, _get_revision
+from cave_gen import gen_cave
+from headless_physics import make_headless_physics
+from Physics import BROADPHASES
+from ShotLog import load_shot_log
+from replay_shots import replay
+
+# pylint: enable=wrong-import-position
+
+# Steps shots through generated caves with Physics under each broadphase and
+# reports how long an update takes while the ball is moving, so that the
+# broadphase can be chosen by cave size from measurements. Shots are random but
+# the same for every broadphase, or are replayed from shot logs. Needs no window
+# or GL context.
+#
+#   python bench_physics.py --sizes easy hard --output results.json
+#   python bench_physics.py --logs logs/*.json
+
+UPDATES_PER_SECOND = 240
+# As PlayScreen sets them.
+PHYSICS_SETTINGS = {
+    "ball_radius": BALL_RADIUS,
+    "max_power": 75,
+    "shot_sensitivity": 0.4,
+    "gravity": (0, -30),
+    "flag_collision_shape_radius": 1.24,
+    "max_ball_step_distance": 0.35,
+    "sticky_radius": 6,
+}
+MAX_SHOT_UPDATES = UPDATES_PER_SECOND * 20
+
+
+def _get_random_shots(seed, num_shots):
+    rng = Random(seed)
+    shots = []
+    for _ in range(num_shots):
+        angle = rng.uniform(0.1, 3.04)
+        power = PHYSICS_SETTINGS["max_power"] * rng.uniform(0.2, 1)
+        shots.append(Vec2(math.cos(angle) * power, math.sin(angle) * power))
+    return shots
+
+
+# Plays the shots one after another from wherever the ball comes to rest, and
+# returns the time every update in a shot took and where each shot ended.
+def _time_shots(cave, broadphase, shots):
+    physics = make_headless_physics(
+        cave,
+        point_shift=(0, 0),
+        updates_per_second=UPDATES_PER_SECOND,
+        physics_settings={**PHYSICS_SETTINGS, "broadphase": broadphase},
+    )
+    dt = 1 / UPDATES_PER_SECOND
+    update_times = []
+    end_positions = []
+    for velocity in shots:
+        physics.shoot(velocity)
+        for _ in range(MAX_SHOT_UPDATES):
+            start = perf_counter()
+            physics.update(dt)
+            update_times.append(perf_counter() - start)
+            if not physics.is_in_shot:
+                break
+        end_positions.append((physics.ball_position[0], physics.ball_position[1]))
+    physics.dispose()
+    return update_times, end_positions
+
+
+def _get_segment_stats(cave):
+    lengths = [
+        math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+        for contour in cave.contours
+        for p1, p2 in zip(contour, contour[1:] + contour[:1])
+    ]
+    return {
+        "num_segments": len(lengths),
+        "median_segment_length": statistics.median(lengths),
+    }
+
+
+def _summarize(update_times):
+    return {
+        "num_updates": len(update_times),
+        "median_us": statistics.median(update_times) * 1e6,
+        "mean_us": statistics.fmean(update_times) * 1e6,
+        "p95_us": statistics.quantiles(update_times, n=20)[-1] * 1e6,
+    }
+
+
+def run(sizes, seeds, num_shots, repeats, broadphases):
+    results = {}
+    for size_name in sizes:
+        width, height = SIZES[size_name]
+        update_times = defaultdict(list)
+        num_diverged = defaultdict(int)
+        segment_stats = []
+        for seed in seeds:
+            cave = gen_cave(width, height, PSEUDO_3D_GROUND_HEIGHT, BALL_RADIUS, seed)
+            segment_stats.append(_get_segment_stats(cave))
+            shots = _get_random_shots(seed, num_shots)
+            # Warm up first so that lazy imports and first-call costs aren't
+            # timed.
+            _time_shots(cave, broadphases[0], shots[:1])
+            base_end_positions = None
+            # Broadphases take turns so that they are timed under the same
+            # conditions.
+            for _ in range(repeats):
+                for broadphase in broadphases:
+                    times, end_positions = _time_shots(cave, broadphase, shots)
+                    update_times[broadphase] += times
+                    if base_end_positions is None:
+                        base_end_positions = end_positions
+                    elif end_positions != base_end_positions:
+                        num_diverged[broadphase] += 1
+        results[size_name] = {
+            "width": width,
+            "height": height,
+            "num_segments": statistics.median(s["num_segments"] for s in segment_stats),
+            "median_segment_length": statistics.median(
+                s["median_segment_length"] for s in segment_stats
+            ),
+            "broadphases": {
+                broadphase: {
+                    **_summarize(update_times[broadphase]),
+                    # Runs whose shots didn't end exactly where the first
+                    # broadphase's did, as the order contacts are found in can
+                    # change the last bits of a result.
+                    "num_diverged": num_diverged[broadphase],
+                }
+                for broadphase in broadphases
+            },
+        }
+    return results
+
+
+# Shot logs are replayed whole, so their updates per second include the
+# updates between shots too.
+def run_logs(paths, broadphases):
+    results = {}
+    for path in paths:
+        log = load_shot_log(path)
+        results[path] = {}
+        for broadphase in broadphases:
+            broadphase_log = {
+                **log,
+                "physics_settings": {
+                    **log["physics_settings"],
+                    "broadphase": broadphase,
+                },
+            }
+            events, num_updates, seconds = replay(broadphase_log)
+            results[path][broadphase] = {
+                "updates_per_second": num_updates / seconds,
+                "is_match": events == log["events"],
+            }
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'size':<8}{'segments':>9}{'broadphase':>14}{'median us':>11}"
+        f"{'mean us':>10}{'p95 us':>10}{'vs first':>10}{'diverged':>10}"
+    )
+    for size_name, size_results in results.items():
+        base_mean = None
+        for broadphase, r in size_results["broadphases"].items():
+            base_mean = base_mean or r["mean_us"]
+            print(
+                f"{size_name:<8}{size_results['num_segments']:>9.0f}"
+                f"{broadphase:>14}{r['median_us']:>11.1f}{r['mean_us']:>10.1f}"
+                f"{r['p95_us']:>10.1f}{r['mean_us'] / base_mean:>9.2f}x"
+                f"{r['num_diverged']:>10}"
+            )
+
+
+def print_log_results(results):
+    for path, path_results in results.items():
+        for broadphase, r in path_results.items():
+            print(
+                f"{'ok' if r['is_match'] else 'MISMATCH':<10}{broadphase:<14}"
+                f"{r['updates_per_second']:>10.0f}/s  {path}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Physics updates under each broadphase."
+    )
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--shots", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--broadphases", nargs="+", choices=BROADPHASES, default=BROADPHASES
+    )
+    parser.add_argument("--logs", nargs="+", help="replay these shot logs instead")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.logs:
+        results = run_logs(args.logs, args.broadphases)
+        print_log_results(results)
+    else:
+        results = run(
+            args.sizes, range(args.seeds), args.shots, args.repeats, args.broadphases
+        )
+        print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "revision": _get_revision(),
+                    "time": time(),
+                    "python": platform.python_version(),
+                    "pymunk": pymunk.version,
+                    "updates_per_second": UPDATES_PER_SECOND,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import struct
+import zlib
+import hashlib
+import numpy as np
+from pyglet.math import Vec2
+from cave_gen import Cave, Flat, gen_cave
+
+
+_magic = b"CAVE"
+_format_version = 5
+_header = struct.Struct("<4sHQII6d")
+_length = struct.Struct("<I")
+
+
+# Caves are content addressed by everything that goes into generating them, so
+# a cached cave is only ever reused for exactly the same seed and mode.
+def _get_cave_key(width, height, pseudo_3d_ground_height, ball_radius, seed):
+    return hashlib.sha256(
+        repr(
+            (
+                _format_version,
+                width,
+                height,
+                pseudo_3d_ground_height,
+                ball_radius,
+                seed,
+            )
+        ).encode()
+    ).hexdigest()
+
+
+# Contour points are whole half-cell coordinates and are stored as int32 pairs,
+# while flats and sand pits (whose floors are curved) are stored as float64.
+# Each contour is stored as the lengths of its runs followed by their points, as
+# the simplified contour is made of the first point of every run.
+def encode_cave(cave):
+    parts = [
+        _header.pack(
+            _magic,
+            _format_version,
+            cave.seed,
+            len(cave.contours),
+            len(cave.sand_pits),
+            cave.start_flat.pos.x,
+            cave.start_flat.pos.y,
+            cave.start_flat.width,
+            cave.flag_flat.pos.x,
+            cave.flag_flat.pos.y,
+            cave.flag_flat.width,
+        )
+    ]
+    for runs in cave.contour_runs:
+        parts.append(_length.pack(len(runs)))
+        parts.append(np.asarray([len(run) for run in runs], dtype="<u4").tobytes())
+        parts.append(
+            np.asarray([point for run in runs for point in run], dtype="<i4").tobytes()
+        )
+    for sand_pit in cave.sand_pits:
+        parts.append(_length.pack(len(sand_pit)))
+        parts.append(np.asarray(sand_pit, dtype="<f8").tobytes())
+    return zlib.compress(b"".join(parts))
+
+
+def decode_cave(data):
+    data = zlib.decompress(data)
+    (
+        magic,
+        format_version,
+        seed,
+        num_contours,
+        num_sand_pits,
+        start_x,
+        start_y,
+        start_width,
+        flag_x,
+        flag_y,
+        flag_width,
+    ) = _header.unpack_from(data)
+    if magic != _magic or format_version != _format_version:
+        raise ValueError("Not a cave in the current format")
+    offset = _header.size
+
+    def read_array(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    def read_points(dtype, num_points):
+        points = read_array(dtype, num_points * 2)
+        return [tuple(point) for point in points.reshape(-1, 2).tolist()]
+
+    def read_length():
+        nonlocal offset
+        (length,) = _length.unpack_from(data, offset)
+        offset += _length.size
+        return length
+
+    def read_runs():
+        run_lengths = read_array("<u4", read_length()).tolist()
+        points = read_points("<i4", sum(run_lengths))
+        runs = []
+        start = 0
+        for run_length in run_lengths:
+            runs.append(points[start : start + run_length])
+            start += run_length
+        return runs
+
+    contour_runs = [read_runs() for _ in range(num_contours)]
+    sand_pits = [read_points("<f8", read_length()) for _ in range(num_sand_pits)]
+    return Cave(
+        seed=seed,
+        contours=[[run[0] for run in runs] for runs in contour_runs],
+        contour_runs=contour_runs,
+        start_flat=Flat(Vec2(start_x, start_y), start_width),
+        flag_flat=Flat(Vec2(flag_x, flag_y), flag_width),
+        sand_pits=sand_pits,
+    )
+
+
+# Loads the cave from the cache if it has been generated before, and otherwise
+# generates and stores it. With no cache_dir this just generates the cave.
+def load_or_gen_cave(
+    cache_dir, width, height, pseudo_3d_ground_height, ball_radius, seed
+):
+    if cache_dir is None:
+        return gen_cave(width, height, pseudo_3d_ground_height, ball_radius, seed)
+    path = os.path.join(
+        cache_dir,
+        _get_cave_key(width, height, pseudo_3d_ground_height, ball_radius, seed)
+        + ".cave",
+    )
+    try:
+        with open(path, "rb") as f:
+            return decode_cave(f.read())
+    except FileNotFoundError:
+        pass
+    except (zlib.error, struct.error, ValueError):
+        pass  # Corrupt or outdated, so generate it again.
+    cave = gen_cave(width, height, pseudo_3d_ground_height, ball_radius, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temporary file first so that other processes never read a
+    # partially written cave.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(encode_cave(cave))
+    os.replace(temp_path, path)
+    return cave
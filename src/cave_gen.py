@@ -1,100 +1,123 @@
 import math
-from random import randint, randrange
-from collections import deque
+from random import Random
+import numpy as np
 from pyglet.math import Vec2
-from shapely.geometry import Polygon
-from collision import (
-    Vector as CollisionVector,
-    Poly,
-    Concave_Poly as ConcavePoly,
-    collide,
-)
+from shapely import STRtree
+from shapely.geometry import Polygon, box
 from Rectangle import Rectangle
+from tracing import span
+
+
+# Edge midpoints of a marching squares cell, as offsets in half-cell units from
+# the cell's bottom left corner: 1 = top, 2 = right, 3 = bottom, 4 = left.
+_cell_edge_point_offsets = np.array([(0, 0), (1, 2), (2, 1), (1, 0), (0, 1)])
+
+# Up to two segments per cell case, each a pair of edge midpoints (0 = unused).
+_marching_squares_table = np.array(
+    [
+        [(0, 0), (0, 0)],
+        [(1, 4), (0, 0)],
+        [(1, 2), (0, 0)],
+        [(2, 4), (0, 0)],
+        [(2, 3), (0, 0)],
+        [(1, 2), (3, 4)],
+        [(1, 3), (0, 0)],
+        [(3, 4), (0, 0)],
+        [(3, 4), (0, 0)],
+        [(1, 3), (0, 0)],
+        [(1, 4), (2, 3)],
+        [(2, 3), (0, 0)],
+        [(2, 4), (0, 0)],
+        [(1, 2), (0, 0)],
+        [(1, 4), (0, 0)],
+        [(0, 0), (0, 0)],
+    ]
+)
 
 
 # Marching squares algorithm
 def make_cave_contours(grid, width, height):
-    edges = {}
-
-    def add_edge(x, y, p1, p2):
-        def coord(x, y, p):
-            if p == 1:
-                dx = 1
-                dy = 2
-            if p == 2:
-                dx = 2
-                dy = 1
-            if p == 3:
-                dx = 1
-                dy = 0
-            if p == 4:
-                dx = 0
-                dy = 1
-            return (x * 2 + dx, y * 2 + dy)
-
-        c1 = coord(x, y, p1)
-        c2 = coord(x, y, p2)
-
-        edges[c1] = (edges[c1][0], c2) if c1 in edges else (c2, None)
-        edges[c2] = (edges[c2][0], c1) if c2 in edges else (c1, None)
-
-    for y in range(height - 1):
-        for x in range(width - 1):
-            case = (
-                grid[y + 1][x]
-                + (grid[y + 1][x + 1] << 1)
-                + (grid[y][x + 1] << 2)
-                + (grid[y][x] << 3)
-            )
+    grid = np.asarray(grid, dtype=np.uint8)
+    cases = (
+        grid[1:, :-1]
+        + (grid[1:, 1:] << 1)
+        + (grid[:-1, 1:] << 2)
+        + (grid[:-1, :-1] << 3)
+    )
 
-            if case == 1:
-                add_edge(x, y, 1, 4)
-            elif case == 2:
-                add_edge(x, y, 1, 2)
-            elif case == 3:
-                add_edge(x, y, 2, 4)
-            elif case == 4:
-                add_edge(x, y, 2, 3)
-            elif case == 5:
-                add_edge(x, y, 1, 2)
-                add_edge(x, y, 3, 4)
-            elif case == 6:
-                add_edge(x, y, 1, 3)
-            elif case == 7:
-                add_edge(x, y, 3, 4)
-            elif case == 8:
-                add_edge(x, y, 3, 4)
-            elif case == 9:
-                add_edge(x, y, 1, 3)
-            elif case == 10:
-                add_edge(x, y, 1, 4)
-                add_edge(x, y, 2, 3)
-            elif case == 11:
-                add_edge(x, y, 2, 3)
-            elif case == 12:
-                add_edge(x, y, 2, 4)
-            elif case == 13:
-                add_edge(x, y, 1, 2)
-            elif case == 14:
-                add_edge(x, y, 1, 4)
-
-    polygons = [[]]
-    c1, (c2, _) = next(iter(edges.items()))
-    while True:
-        polygons[-1].append(c1)
-        del edges[c1]
-        if c2 in edges:
-            c2a, c2b = edges[c2]
-            c1, c2 = c2, c2b if c2a == c1 else c2a
-        elif len(edges) > 0:
-            polygons.append([])
-            c1, (c2, _) = next(iter(edges.items()))
-        else:
-            break
-
-    for polygon in polygons:
-        if _get_signed_area_of_polygon(polygon) > 0:
+    # Segments in the order the cells are scanned (row by row, then by slot in
+    # the table), so the contours come out in the same order and with the same
+    # starting points as when they were built cell by cell.
+    segments = _marching_squares_table[cases].reshape(-1, 2)
+    cell_indices = np.repeat(np.arange(cases.size), 2)
+    is_used = segments[:, 0] > 0
+    segments = segments[is_used]
+    cell_indices = cell_indices[is_used]
+    if len(segments) == 0:
+        return []
+
+    # Points are identified by their index in the (2 * width - 1) wide grid of
+    # half-cell coordinates. Every point lies on exactly two segments.
+    point_grid_width = 2 * width - 1
+    cell_xs = cell_indices % (width - 1)
+    cell_ys = cell_indices // (width - 1)
+    offsets = _cell_edge_point_offsets[segments]
+    points = (2 * cell_ys[:, None] + offsets[:, :, 1]) * point_grid_width + (
+        2 * cell_xs[:, None] + offsets[:, :, 0]
+    )
+    endpoints = points.ravel()
+    partners = points[:, ::-1].ravel()
+    order = np.argsort(endpoints, kind="stable")
+    first_seen = order[0::2]
+    point_ids = endpoints[first_seen]
+    first_neighbours = np.empty(point_grid_width * (2 * height - 1), dtype=np.intp)
+    second_neighbours = np.empty_like(first_neighbours)
+    first_neighbours[point_ids] = partners[first_seen]
+    second_neighbours[point_ids] = partners[order[1::2]]
+    start_ids = point_ids[np.argsort(first_seen)].tolist()
+    first_neighbours = first_neighbours.tolist()
+    second_neighbours = second_neighbours.tolist()
+
+    # Walk each contour from its first seen point towards that point's first
+    # neighbour, which is the order the half-edge dict used to be walked in.
+    walk_ids = []
+    polygon_starts = []
+    is_visited = bytearray(len(first_neighbours))
+    for start_id in start_ids:
+        if is_visited[start_id]:
+            continue
+        polygon_starts.append(len(walk_ids))
+        walk_ids.append(start_id)
+        is_visited[start_id] = 1
+        prev_id = start_id
+        cur_id = first_neighbours[start_id]
+        while cur_id != start_id:
+            walk_ids.append(cur_id)
+            is_visited[cur_id] = 1
+            next_id = first_neighbours[cur_id]
+            if next_id == prev_id:
+                next_id = second_neighbours[cur_id]
+            prev_id, cur_id = cur_id, next_id
+
+    ids = np.array(walk_ids)
+    xs = ids % point_grid_width
+    ys = ids // point_grid_width
+    next_indices = np.arange(1, len(ids) + 1)
+    polygon_ends = polygon_starts[1:] + [len(ids)]
+    next_indices[np.array(polygon_ends) - 1] = polygon_starts
+    double_signed_areas = np.add.reduceat(
+        (xs[next_indices] - xs) * (ys[next_indices] + ys), polygon_starts
+    )
+
+    coords = list(zip(xs.tolist(), ys.tolist()))
+    polygons = []
+    for start, end, double_signed_area in zip(
+        polygon_starts, polygon_ends, double_signed_areas.tolist()
+    ):
+        polygon = coords[start:end]
+        if double_signed_area > 0:
             polygon.reverse()  # make counter-clockwise
+        polygons.append(polygon)
 
     return polygons
 
@@ -129,6 +152,14 @@ class Flat:
     def get_middle(self):
         return Vec2(self.pos.x + self.width / 2, self.pos.y)
 
+    # Vec2 can't be unpickled, so flats are sent between processes as numbers.
+    def __reduce__(self):
+        return (_make_flat, (self.pos.x, self.pos.y, self.width))
+
+
+def _make_flat(x, y, width):
+    return Flat(Vec2(x, y), width)
+
 
 # Gets all the "ground" parts which are flat
 def _get_flat_grounds(contours):
@@ -154,49 +185,36 @@ def _get_flat_grounds(contours):
     return flats
 
 
-# https://github.com/bsharvari/A-Star-Search
-def _min_path_length(grid, start, end):
-    path = []
-    val = 1
-
-    visited = [[0 for _ in range(len(grid[0]))] for _ in range(len(grid))]
-    visited[start[0]][start[1]] = 1
-
-    heuristic = lambda x, y: abs(end[0] - x) + abs(end[1] - y)
-
-    x = start[0]
-    y = start[1]
-    g = 0
-    f = g + heuristic(x, y)
-
-    minList = [f, g, x, y]
-
-    delta = [[-1, 0], [0, -1], [1, 0], [0, 1]]
-
-    while minList[2:] != end:
-        # pylint: disable-next=consider-using-enumerate
-        for i in range(len(delta)):
-            x2 = x + delta[i][0]
-            y2 = y + delta[i][1]
-            if 0 <= x2 < len(grid) and 0 <= y2 < len(grid[0]):
-                if visited[x2][y2] == 0 and grid[x2][y2] == 0:
-                    g2 = g + 1
-                    f2 = g2 + heuristic(x2, y2)
-                    path.append([f2, g2, x2, y2])
-                    visited[x2][y2] = 1
-
-        if not path:
-            raise Exception("No path")
-
-        del minList[:]
-        minList = min(path)
-        path.remove(minList)
-        x = minList[2]
-        y = minList[3]
-        g = minList[1]
-        val += 1
-
-    return minList[1]
+# Breadth first search from every source at once, one array of step distances
+# per source. Unreachable cells are -1. Sources may lie in walls, but the search
+# only ever steps into open cells.
+#
+# The searches share one flat array where cell i of source s is at
+# s * grid.size + i, and only the frontier indices are expanded each step.
+# Stepping off the side of a row or source lands on a border cell, which is
+# always a wall, so the searches never leak into each other.
+def _get_distance_fields(grid, sources):
+    width = grid.shape[1]
+    is_open = (grid == 0).ravel()
+    distance_fields = np.full(len(sources) * grid.size, -1, dtype=np.int32)
+    frontier = (
+        np.arange(len(sources)) * grid.size + sources[:, 0] * width + sources[:, 1]
+    )
+    distance_fields[frontier] = 0
+    steps = np.array([-width, -1, 1, width])
+    distance = 0
+    while len(frontier) > 0:
+        distance += 1
+        neighbours = (frontier[:, None] + steps).ravel()
+        neighbours = neighbours[is_open[neighbours % grid.size]]
+        neighbours = neighbours[distance_fields[neighbours] < 0]
+        # Cells reached from more than one frontier cell are only kept once, by
+        # letting each neighbour claim its cell with a distinct negative value.
+        claims = np.arange(-len(neighbours) - 1, -1)
+        distance_fields[neighbours] = claims
+        frontier = neighbours[distance_fields[neighbours] == claims]
+        distance_fields[frontier] = distance
+    return distance_fields.reshape((len(sources),) + grid.shape)
 
 
 def place_start_flat_and_flag_flat(contours, grid):
@@ -207,16 +225,24 @@ def place_start_flat_and_flag_flat(contours, grid):
         mid = flat.get_middle()
         return [int(mid.y / 2) + 1, int(mid.x / 2)]
 
-    def get_score(start_flat, flag_flat):
-        return flag_flat.width + _min_path_length(
-            grid, flat_to_grid_coords(start_flat), flat_to_grid_coords(flag_flat)
-        )
+    grid_coords = np.array(
+        [flat_to_grid_coords(flat) for flat in flat_grounds], dtype=np.intp
+    ).reshape(-1, 2)
+    # path_lengths[i, j] is the number of steps from flat i to flat j.
+    path_lengths = _get_distance_fields(np.asarray(grid), grid_coords)[
+        :, grid_coords[:, 0], grid_coords[:, 1]
+    ].tolist()
+
+    def get_score(i, j):
+        if path_lengths[i][j] < 0:
+            raise Exception("No path")
+        return flat_grounds[j].width + path_lengths[i][j]
 
     i, j, _ = max(
         (
-            (i, j, get_score(a, b))
-            for i, a in enumerate(flat_grounds)
-            for j, b in enumerate(flat_grounds)
+            (i, j, get_score(i, j))
+            for i in range(len(flat_grounds))
+            for j in range(len(flat_grounds))
             if i != j
         ),
         key=lambda t: t[2],
@@ -232,39 +258,27 @@ def make_sand_pits(
     max_sand_pits,
     avoid_rects,
     ball_radius,
+    rng,
 ):
     # First we walk through the contour to identify possible positions for the
     # sand pits, then we filter these positions (so they don't overlap stuff)
     # and then randomly select the sand pits.
+    #
+    # Overlaps are found with STR-trees, which only shortlist the shapes whose
+    # bounding boxes overlap, so only those are tested exactly.
 
-    avoid_polys = [
-        ConcavePoly(
-            CollisionVector(0, 0), [CollisionVector(v[0], v[1]) for v in inner_contour]
-        )
-        for inner_contour in contours[1:]
-    ] + [
-        Poly(
-            CollisionVector(0, 0),
-            [
-                CollisionVector(rect.pos.x, rect.pos.y),
-                CollisionVector(rect.right, rect.pos.y),
-                CollisionVector(rect.right, rect.top),
-                CollisionVector(rect.pos.x, rect.top),
-            ],
-        )
-        for rect in avoid_rects
-    ]
+    avoid_tree = STRtree(
+        [Polygon(inner_contour) for inner_contour in contours[1:]]
+        + [box(rect.pos.x, rect.pos.y, rect.right, rect.top) for rect in avoid_rects]
+    )
 
     def sand_pit_to_poly(sand_pit):
         shape = Polygon(sand_pit).buffer(ball_radius, 4)
         assert isinstance(shape, Polygon)
-        return ConcavePoly(
-            CollisionVector(0, 0),
-            # pylint: disable-next=no-member
-            [CollisionVector(v[0], v[1]) for v in shape.exterior.coords][:-1],
-        )
+        return shape
 
     sand_pits = []
+    sand_pit_polys = []
     sand_pit_starts = []
     outer_contour = contours[0]
     for i, (v1, v2) in enumerate(zip(outer_contour, outer_contour[1:])):
@@ -282,7 +296,6 @@ def make_sand_pits(
                     break
             if start_index is not None:
                 sand_pit = outer_contour[start_index : i + 2]
-                sand_pit_poly = sand_pit_to_poly(sand_pit)
                 if (
                     len(sand_pit) >= 4
                     # Compare signed area, not absolute area, to also check winding
@@ -293,26 +306,33 @@ def make_sand_pits(
                         <= -_get_signed_area_of_polygon(sand_pit)
                         <= max_sand_pit_area
                     )
-                    and not any(
-                        collide(sand_pit_poly, avoid_poly) for avoid_poly in avoid_polys
-                    )
                 ):
-                    sand_pits.append(sand_pit)
-
-    sand_pit_polys = [sand_pit_to_poly(sand_pit) for sand_pit in sand_pits]
+                    sand_pit_poly = sand_pit_to_poly(sand_pit)
+                    if (
+                        len(avoid_tree.query(sand_pit_poly, predicate="intersects"))
+                        == 0
+                    ):
+                        sand_pits.append(sand_pit)
+                        sand_pit_polys.append(sand_pit_poly)
+
+    # Every pair of overlapping sand pits, found in one query.
+    sand_pit_polys = np.array(sand_pit_polys, dtype=object)
+    overlapping = [[] for _ in sand_pits]
+    for i, j in (
+        STRtree(sand_pit_polys).query(sand_pit_polys, predicate="intersects").T.tolist()
+    ):
+        if i != j:
+            overlapping[i].append(j)
+
+    remaining = list(range(len(sand_pits)))
+    is_selected = [False] * len(sand_pits)
     selected_sand_pits = []
-    selected_sand_pit_polys = []
-    while len(sand_pits) > 0 and len(selected_sand_pits) < max_sand_pits:
-        i = randrange(len(sand_pits))
-        sand_pit = sand_pits.pop(i)
-        sand_pit_poly = sand_pit_polys.pop(i)
-        if any(
-            collide(sand_pit_poly, selected_sand_pit_poly)
-            for selected_sand_pit_poly in selected_sand_pit_polys
-        ):
+    while len(remaining) > 0 and len(selected_sand_pits) < max_sand_pits:
+        i = remaining.pop(rng.randrange(len(remaining)))
+        if any(is_selected[j] for j in overlapping[i]):
             continue
-        selected_sand_pits.append(sand_pit)
-        selected_sand_pit_polys.append(sand_pit_poly)
+        is_selected[i] = True
+        selected_sand_pits.append(sand_pits[i])
 
     for sand_pit in selected_sand_pits:
         top_left = sand_pit[0]
@@ -327,7 +347,216 @@ def make_sand_pits(
     return selected_sand_pits
 
 
+def _get_distance_to_segment(p, a, b):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length_sqrd = dx**2 + dy**2
+    t = (p[0] - a[0]) * dx + (p[1] - a[1]) * dy
+    if t <= 0:
+        return math.dist(p, a)
+    if t >= length_sqrd:
+        return math.dist(p, b)
+    # From the cross product, so that points on the segment are exactly 0 away.
+    return abs((p[0] - a[0]) * dy - (p[1] - a[1]) * dx) / math.sqrt(length_sqrd)
+
+
+# Douglas-Peucker over the points between two kept points, which keeps a point
+# whenever leaving it out would move the wall by more than tolerance or leave a
+# segment longer than max_segment_length. With a tolerance of 0 exactly the
+# corners are kept, as the furthest point from a chord is always a corner.
+def _simplify_span(points, start, end, tolerance, max_segment_length, kept):
+    spans = [(start, end)]
+    while spans:
+        a, b = spans.pop()
+        if b - a < 2:
+            continue
+        p1 = points[a % len(points)]
+        p2 = points[b % len(points)]
+        furthest = None
+        furthest_distance = 0
+        for k in range(a + 1, b):
+            distance = _get_distance_to_segment(points[k % len(points)], p1, p2)
+            if distance > furthest_distance:
+                furthest = k
+                furthest_distance = distance
+        if furthest_distance <= tolerance:
+            if math.dist(p1, p2) <= max_segment_length:
+                continue
+            furthest = (a + b) // 2
+        kept.append(furthest % len(points))
+        spans.append((a, furthest))
+        spans.append((furthest, b))
+
+
+# Returns the indices of the points of the contour which are kept, in order.
+def _simplify_contour(contour, pinned, tolerance, max_segment_length):
+    anchors = sorted(pinned | {0})
+    kept = anchors.copy()
+    for start, end in zip(anchors, anchors[1:] + [anchors[0] + len(contour)]):
+        _simplify_span(contour, start, end, tolerance, max_segment_length, kept)
+    return sorted(kept)
+
+
+# Gets the polygons which aren't valid or whose boundaries touch another's.
+def _get_overlapping_polygons(polygons):
+    overlapping = {i for i, polygon in enumerate(polygons) if not polygon.is_valid}
+    polygons = np.array(polygons, dtype=object)
+    for i, j in STRtree(polygons).query(polygons, predicate="intersects").T.tolist():
+        if i != j and polygons[i].boundary.intersects(polygons[j].boundary):
+            overlapping.add(i)
+    return overlapping
+
+
+# Removes the points of the contours which don't change the shape of the walls,
+# i.e. the middle of straight runs, so the physics and rendering have fewer
+# segments to deal with. Segments are kept below max_segment_length.
+#
+# Also returns the runs of the contours each simplified segment replaced, as the
+# points from its start up to but not including its end, so joining a contour's
+# runs gives back the contour. A sticky covers every whole segment of a wall in
+# its radius, so stickies are placed on the runs rather than on the longer
+# simplified segments.
+#
+# With a tolerance, points which move the walls by no more than it are removed
+# too, but any contour which would then overlap itself or another contour is
+# only merged.
+#
+# Sand pits share their walls with the exterior contour, so the ends of their
+# walls are always kept and their walls are rebuilt from the simplified contour.
+# The segments under the flats are kept as well so that they stay flat.
+def simplify_contours(
+    contours,
+    sand_pits,
+    flats,
+    max_segment_length,
+    tolerance=0,
+):
+    pinned = [set() for _ in contours]
+    outer_contour = contours[0]
+    outer_indices = {point: i for i, point in enumerate(outer_contour)}
+    sand_pit_walls = []
+    for sand_pit in sand_pits:
+        start = outer_indices[sand_pit[0]]
+        end = start
+        while (
+            end - start + 1 < len(sand_pit)
+            and end + 1 < len(outer_contour)
+            and sand_pit[end - start + 1] == outer_contour[end + 1]
+        ):
+            end += 1
+        pinned[0] |= {start, end}
+        sand_pit_walls.append((start, end))
+    for flat in flats:
+        for i, contour in enumerate(contours):
+            for j, c1 in enumerate(contour):
+                c2 = contour[(j + 1) % len(contour)]
+                if (
+                    c1[1] == c2[1] == flat.pos.y
+                    and min(c1[0], c2[0]) < flat.pos.x + flat.width
+                    and max(c1[0], c2[0]) > flat.pos.x
+                ):
+                    pinned[i] |= {j, (j + 1) % len(contour)}
+
+    kept = [
+        _simplify_contour(contour, pinned[i], 0, max_segment_length)
+        for i, contour in enumerate(contours)
+    ]
+    if tolerance > 0:
+        simplified_kept = [
+            _simplify_contour(contour, pinned[i], tolerance, max_segment_length)
+            for i, contour in enumerate(contours)
+        ]
+        is_simplified = [len(indices) >= 3 for indices in simplified_kept]
+        # Merged contours have exactly the same shape as before, so they never
+        # overlap each other. Falling back can uncover new overlaps though, so
+        # this repeats until there are none.
+        while True:
+            polygons = [
+                Polygon(
+                    [
+                        contour[j]
+                        for j in (simplified_kept[i] if is_simplified[i] else kept[i])
+                    ]
+                )
+                for i, contour in enumerate(contours)
+            ]
+            overlapping = [
+                i for i in _get_overlapping_polygons(polygons) if is_simplified[i]
+            ]
+            if len(overlapping) == 0:
+                break
+            for i in overlapping:
+                is_simplified[i] = False
+        kept = [
+            simplified_kept[i] if is_simplified[i] else kept[i]
+            for i in range(len(contours))
+        ]
+
+    simplified_contours = [
+        [contour[j] for j in kept[i]] for i, contour in enumerate(contours)
+    ]
+    simplified_sand_pits = [
+        [outer_contour[j] for j in kept[0] if start <= j <= end]
+        + sand_pit[end - start + 1 :]
+        for sand_pit, (start, end) in zip(sand_pits, sand_pit_walls)
+    ]
+    contour_runs = [
+        [contour[a:b] for a, b in zip(kept[i], kept[i][1:] + [len(contour)])]
+        for i, contour in enumerate(contours)
+    ]
+    return simplified_contours, simplified_sand_pits, contour_runs
+
+
+# Labels each 4-connected open space with a flood fill into a single label
+# buffer. Labels count up from 1 in the order the spaces are first reached when
+# scanning the grid row by row, and 0 marks the walls. Also returns the number
+# of cells with each label, where open_counts[0] is always 0.
+def _label_open_spaces(grid):
+    width = grid.shape[1]
+    is_open = (grid == 0).ravel().tolist()
+    labels = [0] * len(is_open)
+    open_counts = [0]
+    for start in np.flatnonzero(is_open).tolist():
+        if labels[start] != 0:
+            continue
+        label = len(open_counts)
+        labels[start] = label
+        cells_to_visit = [start]
+        open_count = 0
+        while cells_to_visit:
+            i = cells_to_visit.pop()
+            open_count += 1
+            for j in (i - 1, i + 1, i - width, i + width):
+                if is_open[j] and labels[j] == 0:
+                    labels[j] = label
+                    cells_to_visit.append(j)
+        open_counts.append(open_count)
+    return np.reshape(labels, grid.shape), np.array(open_counts)
+
+
 # http://roguebasin.com/?title=Cellular_Automata_Method_for_Generating_Random_Cave-Like_Levels
+def _do_cellular_automata(
+    grid, min_surrounding_walls, row_counts, counts, make_pillars
+):
+    # Counts the walls in each 3x3 neighbourhood as a separable box sum (rows
+    # then columns) into preallocated buffers, then overwrites the interior of
+    # the grid in place. The counts are computed before anything is written so
+    # every cell sees the previous generation.
+    np.add(grid[..., :, :-2], grid[..., :, 1:-1], out=row_counts)
+    row_counts += grid[..., :, 2:]
+    np.add(row_counts[..., :-2, :], row_counts[..., 1:-1, :], out=counts)
+    counts += row_counts[..., 2:, :]
+    interior = grid[..., 1:-1, 1:-1]
+    np.greater_equal(counts, min_surrounding_walls, out=interior)
+    if make_pillars:
+        interior |= counts == 0
+
+
+# Generates batch_size candidate caves at a time as one stacked array and
+# returns the first one that is open enough, along with the number of
+# candidates that were tried. Only one seed is taken from rng, and the nth
+# candidate's wall noise is drawn from a generator seeded by it and n, so the
+# caves and what rng draws next are the same for any batch size.
 def make_cave_grid(
     width,
     height,
@@ -336,103 +565,116 @@ def make_cave_grid(
     iterations,
     pillar_iterations,
     min_open_percent,
+    rng,
+    batch_size=1,
 ):
-    def do_cellular_automata(grid, make_pillars):
-        updated_grid = [row[:] for row in grid]
-
-        for y in range(1, height - 1):
-            for x in range(1, width - 1):
-                count = (
-                    grid[y - 1][x - 1]
-                    + grid[y - 1][x]
-                    + grid[y - 1][x + 1]
-                    + grid[y][x - 1]
-                    + grid[y][x]
-                    + grid[y][x + 1]
-                    + grid[y + 1][x - 1]
-                    + grid[y + 1][x]
-                    + grid[y + 1][x + 1]
-                )
-                is_wall = count >= min_surrounding_walls or (
-                    make_pillars and count == 0
-                )
-                updated_grid[y][x] = 1 if is_wall else 0
-
-        return updated_grid
-
-    def copy_largest_open_space_into_new_grid(grid):
-        def copy_open_space_into_new_grid(start_x, start_y):
-            grid_with_single_open_space = [
-                [1 for _ in range(width)] for _ in range(height)
-            ]
-            grid_with_single_open_space[start_y][start_x] = 0
-            cell_coordinates_to_visit = deque([(start_x, start_y)])
-            open_count = 1
-
-            def check_empty(x, y):
-                nonlocal open_count
-                if grid[y][x] == 0 and grid_with_single_open_space[y][x] == 1:
-                    grid_with_single_open_space[y][x] = 0
-                    cell_coordinates_to_visit.append((x, y))
-                    open_count += 1
-
-            while len(cell_coordinates_to_visit) > 0:
-                x, y = cell_coordinates_to_visit.popleft()
-                grid_with_single_open_space[y][x] = 0
-                check_empty(x - 1, y)
-                check_empty(x + 1, y)
-                check_empty(x, y - 1)
-                check_empty(x, y + 1)
-
-            return (grid_with_single_open_space, open_count)
-
-        isolated_open_space_grids = []
-
-        for start_y in range(1, height - 1):
-            for start_x in range(1, width - 1):
-                if grid[start_y][start_x] == 0 and all(
-                    t[0][start_y][start_x] == 1 for t in isolated_open_space_grids
-                ):
-                    isolated_open_space_grids.append(
-                        copy_open_space_into_new_grid(start_x, start_y)
-                    )
-
-        return max(isolated_open_space_grids, key=lambda t: t[1])
+    seed = rng.getrandbits(64)
+    row_counts = np.empty((batch_size, height, width - 2), dtype=np.uint8)
+    counts = np.empty((batch_size, height - 2, width - 2), dtype=np.uint8)
+    min_open_count = min_open_percent * width * height
+    num_candidates_tried = 0
 
     while True:
-        grid = [[0 for _ in range(width)] for _ in range(height)]
-
-        for y in range(height):
-            for x in range(width):
-                if (
-                    x == 0
-                    or y == 0
-                    or x == width - 1
-                    or y == height - 1
-                    or randint(0, 100) <= wall_chance
-                ):
-                    grid[y][x] = 1
+        grids = np.ones((batch_size, height, width), dtype=np.uint8)
+        for i in range(batch_size):
+            noise = np.random.default_rng((seed, num_candidates_tried + i)).integers(
+                0, 101, (height - 2, width - 2), dtype=np.uint8
+            )
+            np.less_equal(
+                noise, wall_chance, out=grids[i, 1:-1, 1:-1], casting="unsafe"
+            )
 
         for _ in range(pillar_iterations):
-            grid = do_cellular_automata(grid, make_pillars=True)
+            _do_cellular_automata(
+                grids, min_surrounding_walls, row_counts, counts, make_pillars=True
+            )
 
         for _ in range(iterations):
-            grid = do_cellular_automata(grid, make_pillars=False)
-
-        found_open = False
-        for y in range(1, height - 1):
-            for x in range(1, width - 1):
-                if grid[y][x] == 0:
-                    found_open = True
-                    break
-            if found_open:
-                break
-        if not found_open:
-            continue
+            _do_cellular_automata(
+                grids, min_surrounding_walls, row_counts, counts, make_pillars=False
+            )
 
-        (
-            grid_with_single_open_space,
-            open_count,
-        ) = copy_largest_open_space_into_new_grid(grid)
-        if open_count >= min_open_percent * width * height:
-            return grid_with_single_open_space
+        # The largest open space can't be bigger than all the open cells
+        # together, so most rejected candidates never need to be labelled.
+        total_open_counts = width * height - grids.sum(axis=(1, 2))
+        for grid, total_open_count in zip(grids, total_open_counts.tolist()):
+            num_candidates_tried += 1
+            if total_open_count == 0 or total_open_count < min_open_count:
+                continue
+            labels, open_counts = _label_open_spaces(grid)
+            largest_label = np.argmax(open_counts[1:]) + 1
+            if open_counts[largest_label] >= min_open_count:
+                return (labels != largest_label).astype(np.uint8), num_candidates_tried
+
+
+class Cave:
+    def __init__(self, seed, contours, contour_runs, start_flat, flag_flat, sand_pits):
+        self.seed = seed
+        self.contours = contours
+        self.contour_runs = contour_runs
+        self.start_flat = start_flat
+        self.flag_flat = flag_flat
+        self.sand_pits = sand_pits
+
+
+# The same seed and arguments always generate the same cave. Each stage runs
+# inside measure_stage(name), which benchmarks use to time the stages, and which
+# otherwise traces them. If stats is given, the number of grid candidates tried
+# is stored in it as num_grid_candidates.
+def gen_cave(
+    width,
+    height,
+    pseudo_3d_ground_height,
+    ball_radius,
+    seed,
+    measure_stage=span,
+    stats=None,
+    grid_batch_size=2,
+):
+    rng = Random(seed)
+    with measure_stage("make_cave_grid"):
+        cave_grid, num_grid_candidates = make_cave_grid(
+            width=width,
+            height=height,
+            wall_chance=40,
+            min_surrounding_walls=5,
+            iterations=5,
+            pillar_iterations=5,
+            min_open_percent=0.3,
+            rng=rng,
+            batch_size=grid_batch_size,
+        )
+    if stats is not None:
+        stats["num_grid_candidates"] = num_grid_candidates
+    with measure_stage("make_cave_contours"):
+        cave_contours = make_cave_contours(cave_grid, width, height)
+    with measure_stage("place_start_flat_and_flag_flat"):
+        start_flat, flag_flat = place_start_flat_and_flag_flat(cave_contours, cave_grid)
+    with measure_stage("make_sand_pits"):
+        sand_pits = make_sand_pits(
+            contours=cave_contours,
+            min_sand_pit_area=2,
+            max_sand_pit_area=36,
+            max_sand_pits=rng.choice((2, 3, 3, 3, 3, 4, 5)),
+            avoid_rects=[
+                start_flat.make_rect(pseudo_3d_ground_height),
+                flag_flat.make_rect(pseudo_3d_ground_height),
+            ],
+            ball_radius=ball_radius,
+            rng=rng,
+        )
+    with measure_stage("simplify_contours"):
+        cave_contours, sand_pits, contour_runs = simplify_contours(
+            contours=cave_contours,
+            sand_pits=sand_pits,
+            flats=[start_flat, flag_flat],
+            max_segment_length=6,
+        )
+    return Cave(
+        seed=seed,
+        contours=cave_contours,
+        contour_runs=contour_runs,
+        start_flat=start_flat,
+        flag_flat=flag_flat,
+        sand_pits=sand_pits,
+    )
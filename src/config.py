@@ -3,10 +3,36 @@ from pyglet.window import key
 
 class _Config:
     def __init__(self):
+        # Fast shots are substepped, so 120 also works and costs about half as
+        # much, but bounces don't come out exactly as they do at 240.
         self.updates_per_second = 240
         self.target_fps = 60
+        # 0.1 s of updates.
+        self.max_updates_per_tick = 24
+        self.frame_stats_capacity = 1200
+        self.frame_stats_overlay_keys = [key.F3]
+        self.show_frame_stats_overlay = False
+        self.frame_stats_path = None
+        self.trace_keys = [key.F4]
+        self.trace_dir = "traces"
+        self.is_tracing_on_start = False
+        self.gpu_profiler_keys = [key.F5]
+        self.is_gpu_profiling_on_start = False
+        self.gpu_profiler_buffered_frames = 2
         self.place_sticky_mode_keys = [key.G]
         self.cancel_keys = [key.ESCAPE, key.DELETE, key.BACKSPACE, key.C]
+        self.cave_generation_processes = 1
+        self.cave_generation_look_ahead = 2
+        self.cave_generation_poll_interval = 1 / 30
+        self.cave_cache_dir = None
+        self.shot_log_dir = None
+        self.physics_broadphase = "bb_tree"
+        # Shows each hole's par, which keeps the hole solver's worker busy
+        # solving the holes. Off by default, and while it is off the hole
+        # solver never runs.
+        self.show_par = False
+        self.hole_solver_processes = 1
+        self.hole_solver_poll_interval = 1 / 30
 
 
 _config = None
@@ -0,0 +1,61 @@
+from pyglet.math import Vec2
+from InputSource import ScriptedInputSource
+from Physics import Physics
+
+
+# Builds Physics for a cave the same way PlayScreen does, but with nothing to
+# draw and no window, for replays and solvers. Points are shifted by
+# point_shift, as PlayScreen shifts them to fit around the geometry.
+# physics_settings are the settings PlayScreen passes to Physics as well.
+def make_headless_physics(
+    cave,
+    point_shift,
+    updates_per_second,
+    physics_settings,
+    input_source=None,
+    recorder=None,
+    on_reach_flag=None,
+):
+    point_shift = Vec2(point_shift[0], point_shift[1])
+    settings = dict(physics_settings)
+    settings["gravity"] = Vec2(*settings["gravity"])
+    # Shot logs from before the broadphase could be chosen used the default.
+    settings.setdefault("broadphase", "bb_tree")
+
+    def shift_points(points):
+        return [(p[0] + point_shift.x, p[1] + point_shift.y) for p in points]
+
+    return Physics(
+        updates_per_second=updates_per_second,
+        input_source=input_source or ScriptedInputSource(),
+        camera=None,
+        contours=[shift_points(contour) for contour in cave.contours[1:]],
+        exterior_contour=shift_points(cave.contours[0]),
+        contour_runs=[
+            [shift_points(run) for run in runs] for runs in cave.contour_runs[1:]
+        ],
+        exterior_contour_runs=[shift_points(run) for run in cave.contour_runs[0]],
+        sand_pits=[shift_points(sand_pit) for sand_pit in cave.sand_pits],
+        ball_position=cave.start_flat.get_middle()
+        + point_shift
+        + Vec2(0, settings["ball_radius"]),
+        flag_position=cave.flag_flat.get_middle() + point_shift,
+        shot_preview_simulation_updates=updates_per_second * 3,
+        shot_preview_velocity_quantum=0.1,
+        updates_per_new_ball_trail_point=max(updates_per_second // 30, 1),
+        num_ball_trail_points=15,
+        ball_trail_width=settings["ball_radius"] / 2,
+        on_new_sticky=lambda _sticky: None,
+        on_sticky_removed=lambda _sticky: None,
+        on_reach_flag=on_reach_flag or (lambda: None),
+        on_hole_animation_done=lambda: None,
+        hole_animation_to_over_hole_duration=0.1,
+        hole_animation_to_in_hole_duration=0.2,
+        on_shot_start=lambda: None,
+        on_shot_end=lambda: None,
+        get_is_paused=lambda: False,
+        on_ball_sticky_collision=lambda: None,
+        on_ball_sand_collision=lambda: None,
+        recorder=recorder,
+        **settings,
+    )
@@ -0,0 +1,110 @@
+import argparse
+import glob
+import os
+import sys
+from time import perf_counter
+import pyglet
+
+# Nothing is drawn, so pyglet mustn't open the hidden window it shares GL
+# contexts with, which also means no display is needed.
+pyglet.options["shadow_window"] = False
+
+# pylint: disable=wrong-import-position
+from pyglet.math import Vec2
+from cave_gen import gen_cave
+from headless_physics import make_headless_physics
+from ShotLog import ShotRecorder, load_shot_log
+
+# pylint: enable=wrong-import-position
+
+# Replays shot logs recorded with config().shot_log_dir set through Physics,
+# with no window, as fast as the solver goes. Checks that every shot ends in
+# exactly the same place it did when it was played and reports the updates per
+# second.
+#
+#   python replay_shots.py logs/
+
+
+# Replays the log and returns the events recorded during the replay, along
+# with the number of updates it took and how long they took.
+def replay(log):
+    recorder = ShotRecorder(
+        seed=log["seed"],
+        cave_args=log["cave_args"],
+        updates_per_second=log["updates_per_second"],
+        point_shift=log["point_shift"],
+        physics_settings=log["physics_settings"],
+    )
+    width, height, pseudo_3d_ground_height, ball_radius = log["cave_args"]
+    physics = make_headless_physics(
+        gen_cave(width, height, pseudo_3d_ground_height, ball_radius, log["seed"]),
+        point_shift=log["point_shift"],
+        updates_per_second=log["updates_per_second"],
+        physics_settings=log["physics_settings"],
+        recorder=recorder,
+    )
+    dt = 1 / log["updates_per_second"]
+    events = log["events"]
+    last_update_num = max((event[1] for event in events), default=0)
+    start = perf_counter()
+    for kind, update_num, x, y in events:
+        if kind == "shot":
+            # Shots start in the update they are recorded in.
+            while physics.update_num < update_num - 1:
+                physics.update(dt)
+            if physics.is_in_shot:
+                break  # The last shot hasn't ended, so the replay has diverged.
+            physics.shoot(Vec2(x, y))
+        elif kind == "sticky":
+            # Stickies are placed after the update they are recorded in.
+            while physics.update_num < update_num:
+                physics.update(dt)
+            physics.place_sticky(Vec2(x, y))
+    while physics.update_num < last_update_num:
+        physics.update(dt)
+    seconds = perf_counter() - start
+    physics.dispose()
+    return recorder.log["events"], physics.update_num, seconds
+
+
+def _get_log_paths(paths):
+    log_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            log_paths += sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            log_paths.append(path)
+    return log_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay shot logs and check that they end the same way."
+    )
+    parser.add_argument("paths", nargs="+", help="shot logs or directories of them")
+    args = parser.parse_args()
+
+    total_updates = 0
+    total_seconds = 0
+    num_mismatches = 0
+    for path in _get_log_paths(args.paths):
+        log = load_shot_log(path)
+        events, num_updates, seconds = replay(log)
+        is_match = events == log["events"]
+        if not is_match:
+            num_mismatches += 1
+        total_updates += num_updates
+        total_seconds += seconds
+        print(
+            f"{'ok' if is_match else 'MISMATCH':<10}{num_updates:>8} updates"
+            f"{num_updates / seconds:>12.0f}/s  {path}"
+        )
+    if total_seconds > 0:
+        print(f"{total_updates} updates at {total_updates / total_seconds:.0f}/s")
+    if num_mismatches > 0:
+        print(f"{num_mismatches} logs did not replay the same")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import pyglet
+from pyglet.math import Vec2
+
+
+# Plays each sequence of shots through Physics from the start of the cave, as
+# the game would, until one of them reaches the flag. Returns its index and the
+# number of its shots it took, or None if none of them reach the flag. A shot
+# which hasn't come to rest after max_shot_updates updates ends its sequence.
+#
+# This runs in HoleSolver's worker processes, which draw nothing, so pyglet
+# mustn't open the hidden window it shares GL contexts with, which importing
+# Physics would do.
+def find_shots_reaching_flag(
+    cave, updates_per_second, physics_settings, shot_sequences, max_shot_updates
+):
+    pyglet.options["shadow_window"] = False
+    # pylint: disable-next=import-outside-toplevel
+    from headless_physics import make_headless_physics
+
+    dt = 1 / updates_per_second
+    for i, shots in enumerate(shot_sequences):
+        reached_flag = []
+        physics = make_headless_physics(
+            cave,
+            point_shift=(0, 0),
+            updates_per_second=updates_per_second,
+            physics_settings=physics_settings,
+            on_reach_flag=lambda: reached_flag.append(True),
+        )
+        for num_shots, velocity in enumerate(shots, 1):
+            physics.shoot(Vec2(velocity[0], velocity[1]))
+            num_updates = 0
+            while num_updates == 0 or (
+                physics.is_in_shot
+                and not reached_flag
+                and num_updates < max_shot_updates
+            ):
+                physics.update(dt)
+                num_updates += 1
+            if reached_flag:
+                physics.dispose()
+                return i, num_shots
+            if physics.is_in_shot:
+                break
+        physics.dispose()
+    return None
@@ -0,0 +1,179 @@
+from collections import deque
+import functools
+import json
+import multiprocessing
+import os
+import threading
+from time import perf_counter_ns, time
+
+
+_max_events = 1000000
+_is_enabled = False
+# When tracing last started, in perf_counter_ns.
+_start_ns = 0
+_pid = os.getpid()
+# Spans as (name, start ns, end ns, pid, tid, args). Once there are
+# _max_events the oldest are dropped.
+_events = deque(maxlen=_max_events)
+_process_names = {}
+_thread_names = {}
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    __slots__ = ["_name", "_args", "_start"]
+
+    def __init__(self, name, args):
+        self._name = name
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *_exc_info):
+        end = perf_counter_ns()
+        tid = threading.get_native_id()
+        if (_pid, tid) not in _thread_names:
+            _thread_names[(_pid, tid)] = threading.current_thread().name
+        _events.append((self._name, self._start, end, _pid, tid, self._args))
+        return False
+
+
+# Times what runs inside it as a span named name, with the keyword arguments
+# shown alongside it, if tracing is enabled:
+#
+#   with span("blur", iterations=10):
+#       ...
+#
+# While tracing is disabled a shared span which does nothing is returned, so
+# spans can be left in hot paths.
+def span(name, **args):
+    if not _is_enabled:
+        return _no_span
+    return _Span(name, args)
+
+
+# Traces every call of the function as a span named after it.
+def traced(fn):
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def traced_fn(*args, **kwargs):
+        if not _is_enabled:
+            return fn(*args, **kwargs)
+        with _Span(name, {}):
+            return fn(*args, **kwargs)
+
+    return traced_fn
+
+
+def is_enabled():
+    return _is_enabled
+
+
+def start():
+    # pylint: disable-next=global-statement
+    global _is_enabled, _start_ns, _pid
+    _is_enabled = True
+    _start_ns = perf_counter_ns()
+    _pid = os.getpid()
+    _process_names[_pid] = multiprocessing.current_process().name
+
+
+def stop():
+    # pylint: disable-next=global-statement
+    global _is_enabled
+    _is_enabled = False
+
+
+def clear():
+    _events.clear()
+    _process_names.clear()
+    _thread_names.clear()
+
+
+# Runs fn in a worker process, traced, and returns its result along with the
+# spans it recorded so that they can be added to the submitting process's trace.
+# Spans are recorded whether or not the submitting process is tracing, as it may
+# have started by the time the result is taken.
+def _call_traced(fn, *args):
+    start()
+    try:
+        with span(fn.__name__):
+            result = fn(*args)
+        return result, (list(_events), dict(_process_names), dict(_thread_names))
+    finally:
+        stop()
+        clear()
+
+
+# Submits fn to a process pool executor so that, while tracing, the work it
+# does in the worker shows up in the trace. The result must be taken with
+# get_traced_result.
+def submit_traced(executor, fn, *args):
+    return executor.submit(_call_traced, fn, *args)
+
+
+def get_traced_result(future):
+    result, (events, process_names, thread_names) = future.result()
+    if _is_enabled:
+        # Spans which were over before tracing started are left out, but those
+        # still running then are kept.
+        _events.extend(event for event in events if event[2] >= _start_ns)
+        _process_names.update(process_names)
+        _thread_names.update(thread_names)
+    return result
+
+
+# The trace in Chrome's trace event format, which chrome://tracing and
+# Perfetto open. Every process's perf_counter uses the same monotonic clock,
+# so spans from worker processes line up with the game's.
+def get_chrome_trace():
+    trace_events = []
+    for pid, name in _process_names.items():
+        trace_events.append(
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+        )
+    for (pid, tid), name in _thread_names.items():
+        trace_events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+        )
+    for name, start_ns, end_ns, pid, tid, args in _events:
+        trace_events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start_ns / 1000,
+                "dur": (end_ns - start_ns) / 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def save(trace_dir):
+    os.makedirs(trace_dir, exist_ok=True)
+    path = os.path.join(trace_dir, f"trace-{int(time() * 1000)}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(get_chrome_trace(), f)
+    return path